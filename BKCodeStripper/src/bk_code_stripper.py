@@ -3,10 +3,12 @@ import os
 import signal
 import sys
 import threading
-from urllib.request import urlopen
 import pika
 from pika import exceptions
 from dotenv import load_dotenv
+import http_cache
+import menu_source_store
+import code_codec
 import logging
 import time
 
@@ -39,16 +41,21 @@ def get_codes(data_obj_json):
 
     return codes # get_codes()
 
-def get_json_from_url(url):
-    response = urlopen(url)
-    logging.info(f"( get_json_from_url ) - urlopen({url}) response:{response}")
-    return json.loads(response.read()) # get_json_from_url
+# fetches the catalog and keeps it in the menu source store, so the
+# formatter can read the same catalog by ref instead of downloading it.
+# returns the parsed catalog and its ref, None when it could not be stored
+def get_catalog_snapshot(url):
+    content = http_cache.get_content(url)
+    logging.info(f"( get_catalog_snapshot ) - get({url}) {len(content)} bytes")
+    data_json = json.loads(content)
+    snapshot_ref = menu_source_store.put_snapshot('bk', content)
+    return data_json, snapshot_ref # get_catalog_snapshot
 
 def add_meta_code(code_list):
     formatted_list = ["bgk-" + code for code in code_list]
     return formatted_list
 
-def send_codes(rabbit_host, rabbit_port, rabbit_username, rabbit_password, codes, queue_name):
+def send_codes(rabbit_host, rabbit_port, rabbit_username, rabbit_password, codes, queue_name, snapshot_ref=None):
     logging.info("( send_codes ) credentials")
     credentials = pika.PlainCredentials(rabbit_username, rabbit_password)
 
@@ -69,9 +76,15 @@ def send_codes(rabbit_host, rabbit_port, rabbit_username, rabbit_password, codes
     channel.queue_declare(queue=queue_name, durable=True)
 
     logging.info("( send_codes ) send codes")
-    str_codes = str(codes)
-    logging.info(f"( send_codes ) - code: {str_codes} ")
-    channel.basic_publish(exchange='', routing_key=queue_name, body=str_codes)
+    logging.info(f"( send_codes ) - codes: {codes} ")
+    headers = {'x-snapshot-ref': snapshot_ref} if snapshot_ref else None
+    logging.info(f"( send_codes ) - snapshot ref: {snapshot_ref} ")
+    channel.basic_publish(
+        exchange='',
+        routing_key=queue_name,
+        body=code_codec.encode(codes),
+        properties=pika.BasicProperties(content_type=code_codec.CONTENT_TYPE, headers=headers)
+    )
 
     logging.info("( send_codes ) close connection")
     connection.close() # send_codes
@@ -82,12 +95,12 @@ def run_code_stripper(RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USERNAME, RABBITMQ_
         code_queue_name = os.getenv('CODE_QUEUE_NAME')
         logging.info(f"( run_code_stripper ) - code_queue_name: {code_queue_name}")
         logging.info("( run_code_stripper ) - Starting the run process...")
-        data_json = get_json_from_url(bk_url)
+        data_json, snapshot_ref = get_catalog_snapshot(bk_url)
         codes = get_codes(data_json)
         logging.info(f"( run_code_stripper ) - get_codes({codes}) ")
         formatted_codes = add_meta_code(codes)
         logging.info(f"( run_code_stripper ) - formatted_codes: {formatted_codes} ")
-        send_codes(RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USERNAME, RABBITMQ_PASSWORD, formatted_codes, code_queue_name)
+        send_codes(RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USERNAME, RABBITMQ_PASSWORD, formatted_codes, code_queue_name, snapshot_ref)
         logging.info("Run process completed successfully.")
 
     except Exception as e:
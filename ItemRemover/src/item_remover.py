@@ -7,6 +7,8 @@ import time
 from pika import exceptions
 import pika
 import requests
+import http_client
+import code_codec
 from dotenv import load_dotenv
 
 # global flag
@@ -27,18 +29,10 @@ def delete_items(codes, db_port, api_url):
         logging.error("db_port is empty")
 
     for code in codes:
-        trimmed_code = code.replace("]", '')
-        trimmed_code = trimmed_code.replace("[", '')
-        trimmed_code = trimmed_code.replace("'", '')
-        trimmed_code = trimmed_code.replace("/", '')
-        trimmed_code = trimmed_code.replace("\\", '')
-        trimmed_code = trimmed_code.replace('"', '')
-        trimmed_code = trimmed_code.replace(" ", '')
-        trimmed_code = trimmed_code.replace("mcd-", '')
-        trimmed_code = trimmed_code.replace("bgk-", '')
-        api_url = f'{api_url}{trimmed_code}'
+        trimmed_code = code_codec.strip_meta_code(code)
+        delete_url = f'{api_url}{trimmed_code}'
         try:
-            response = requests.delete(api_url)
+            response = http_client.delete(delete_url)
             response.raise_for_status()
             print(f"Successfully deleted code: {trimmed_code}")
         except requests.exceptions.RequestException as e:
@@ -46,9 +40,8 @@ def delete_items(codes, db_port, api_url):
     # delete_items
 
 def on_message(ch, method, props, body, db_port, api_url):
-    queue_code = body.decode('utf-8')
-    string_to_list = queue_code.split(',')
-    delete_items(string_to_list, db_port, api_url)
+    codes = code_codec.decode(body, props.content_type)
+    delete_items(codes, db_port, api_url)
 
 def create_on_message_callback(db_port, api_url):
     logging.info(f"( create_on_message_callback ) create_on_message_callback")
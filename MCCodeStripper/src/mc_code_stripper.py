@@ -5,6 +5,7 @@ import threading
 import time
 import pika
 import re
+import code_codec
 from dotenv import load_dotenv
 from pika import exceptions
 
@@ -34,10 +35,14 @@ def send_codes(codes, queue_name, ch):
     ch.queue_declare(queue=queue_name, durable=True)
     logging.info(f"( send_codes ) queue_name: {queue_name}")
 
-    str_codes = str(codes)
-    logging.info(f"( send_codes ) str_code: {str_codes}")
+    logging.info(f"( send_codes ) codes: {codes}")
 
-    ch.basic_publish(exchange='', routing_key=queue_name, body=str_codes)
+    ch.basic_publish(
+        exchange='',
+        routing_key=queue_name,
+        body=code_codec.encode(codes),
+        properties=pika.BasicProperties(content_type=code_codec.CONTENT_TYPE)
+    )
     # send_codes
 
 def add_meta_code(code_list):
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import requests
+import http_client
+
+# content hash of a catalog dict, the same catalog always gets the same id
+def snapshot_id(catalog):
+    return hashlib.sha256(json.dumps(catalog, sort_keys=True).encode('utf-8')).hexdigest() # snapshot_id
+
+# the converted item catalog, kept between user parameter messages.
+# the catalog is revalidated once ttl_seconds have passed or after
+# invalidate(), with If-None-Match so an unchanged catalog comes back as a
+# 304 without a body. when item_db can not be reached the last catalog is
+# served until it can. while one thread revalidates, the others keep
+# getting the catalog they had instead of waiting for item_db.
+# every catalog gets a snapshot id, see snapshot_id
+# uri     = item_db codecal endpoint
+# convert = turns the fetched list into the catalog dict
+class CatalogCache:
+    def __init__(self, uri, ttl_seconds, convert):
+        self.uri = uri
+        self.ttl_seconds = ttl_seconds
+        self.convert = convert
+        self.catalog = None
+        self.snapshot_id = None
+        self.published_id = None
+        self.etag = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.checked_at = 0.0
+        logging.info("( CatalogCache.invalidate ) catalog marked stale")
+
+    def stale(self):
+        return self.catalog is None or time.monotonic() - self.checked_at >= self.ttl_seconds
+
+    # returns the snapshot id and the catalog
+    def get(self):
+        with self.lock:
+            if not self.stale():
+                return self.snapshot_id, self.catalog
+            has_catalog = self.catalog is not None
+
+        # only the first thread to find it stale revalidates, without a
+        # catalog to serve the others wait for it
+        if not self.refresh_lock.acquire(blocking=not has_catalog):
+            with self.lock:
+                return self.snapshot_id, self.catalog
+        try:
+            with self.lock:
+                stale = self.stale()
+            if stale:
+                self.revalidate()
+        finally:
+            self.refresh_lock.release()
+
+        with self.lock:
+            return self.snapshot_id, self.catalog
+
+    # the snapshot id and catalog when the catalog has changed since the
+    # last mark_published, None otherwise
+    def unpublished(self):
+        with self.lock:
+            if self.catalog is None or self.snapshot_id == self.published_id:
+                return None
+            return self.snapshot_id, self.catalog
+
+    def mark_published(self, published_id):
+        with self.lock:
+            self.published_id = published_id
+
+    # fetches the catalog outside self.lock, only ever run by one thread
+    def revalidate(self):
+        with self.lock:
+            headers = {'If-None-Match': self.etag} if self.etag and self.catalog is not None else {}
+        try:
+            response = http_client.get(self.uri, headers=headers)
+            logging.info(f"( CatalogCache.revalidate ) response code: {response.status_code}")
+            if response.status_code == 304:
+                with self.lock:
+                    self.checked_at = time.monotonic()
+                return
+            response.raise_for_status()
+
+            items = response.json()
+            if not isinstance(items, list):
+                logging.info("( CatalogCache.revalidate ) Unexpected data format: Expected a list of codes.")
+                return
+
+            catalog = self.convert(items)
+            if catalog is None:
+                return
+            catalog_id = snapshot_id(catalog)
+            with self.lock:
+                self.catalog = catalog
+                self.snapshot_id = catalog_id
+                self.etag = response.headers.get('ETag')
+                self.checked_at = time.monotonic()
+            logging.info(f"( CatalogCache.revalidate ) catalog of {len(catalog)} items, snapshot: {catalog_id} etag: {self.etag}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(f"( CatalogCache.revalidate ) An error occurred: {e}")
@@ -1,3 +1,4 @@
+import functools
 import json
 import logging
 import os
@@ -5,10 +6,11 @@ import sys
 import threading
 import signal
 import time
+from concurrent.futures import ThreadPoolExecutor
 import pika
 from pika import exceptions
-import requests
 from dotenv import load_dotenv
+from catalog_cache import CatalogCache
 
 # global flag
 shutdown_flag = threading.Event()
@@ -34,23 +36,6 @@ def convert_list_to_dict(lst):
     except Exception as e:
         logging.error(f"( convert_list_to_dict ) Error when trying to convert list to dict : {e}")
 
-## get codes and kcal from db
-def get_codes_foodtype_and_calories_from_db(uri):
-    try:
-        response = requests.get(uri)
-        logging.info(f"( get_codes_foodtype_and_calories_from_db ) response code: {response.status_code}")
-        response.raise_for_status()
-
-        code_cal_foodtype_response = response.json()
-        if isinstance(code_cal_foodtype_response, list):
-            return code_cal_foodtype_response
-        else:
-            logging.info(f"( get_codes_foodtype_and_calories_from_db ) Unexpected data format: Expected a list of codes.")
-            return []
-    except requests.exceptions.RequestException as e:
-        logging.error(f"( get_codes_foodtype_and_calories_from_db ) An error occurred: {e}")
-        return []
-
 ## send pairs to queue
 def send_packet_to_queue(channel, codeKcal_queue_name, packet):
     try:
@@ -65,15 +50,37 @@ def send_packet_to_queue(channel, codeKcal_queue_name, packet):
             )
         )
         logging.info(f"( send_packet_to_queue ) Sent message to {codeKcal_queue_name}")
+        return True
     except Exception as e:
         logging.error(f"( send_packet_to_queue ) Error sending packet: {e}")
+        return False
+
+## publishes a menu snapshot on the snapshot exchange, the sorter keeps it
+## and looks it up by the snapshotId of the packets made on it
+def publish_snapshot(channel, snapshot_exchange_name, snapshot):
+    snapshot_id, catalog = snapshot
+    try:
+        channel.basic_publish(
+            exchange=snapshot_exchange_name,
+            routing_key='',
+            body=json.dumps({'snapshotId': snapshot_id, 'menu': catalog}),
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+            )
+        )
+        logging.info(f"( publish_snapshot ) published snapshot {snapshot_id} of {len(catalog)} items")
+        return True
+    except Exception as e:
+        logging.error(f"( publish_snapshot ) Error publishing snapshot: {e}")
+        return False
 
 def graceful_shutdown(signal, frame):
     shutdown_flag.set()
     logging.info(f"( graceful_shutdown ) Signal {signal} received. Shutting down.")
 
-## makes data packet from param queue parameters and data from the database
-def process_message(body, codekcal_queue_name, gw_port, item_db_uri):
+## makes data packet from param queue parameters and the cached item catalog
+## with a snapshot exchange the packet only refers to the catalog by its snapshotId
+def process_message(body, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name):
     try:
         params = json.loads(body.decode('utf-8'))
         logging.info(f"( process_message ) Processing parameters:{type(params)} {params}")
@@ -81,14 +88,15 @@ def process_message(body, codekcal_queue_name, gw_port, item_db_uri):
         for value in param_values:
             logging.info(f"( process_message ) Processing value {type(value)} {value}")
 
-        # Fetch data from the database
-        codes_foodtype_and_calories = get_codes_foodtype_and_calories_from_db(item_db_uri)
-        if not codes_foodtype_and_calories:
+        # catalog from the database, already converted to a dict
+        snapshot_id, code_cal_foodtype_dict = catalog_cache.get()
+        if not code_cal_foodtype_dict:
             logging.info("( process_message ) No data fetched from DB. Skipping packet creation.")
             return
 
-        # Convert list to dictionary
-        code_cal_foodtype_dict = convert_list_to_dict(codes_foodtype_and_calories)
+        if snapshot_exchange_name:
+            return {**params, 'snapshotId': snapshot_id}
+
         logging.info(f"( process_message ) Processing codes calories: {type(code_cal_foodtype_dict)}")
 
         # Combine data into a single packet
@@ -103,12 +111,26 @@ def process_message(body, codekcal_queue_name, gw_port, item_db_uri):
     except Exception as e:
         logging.error(f"Error processing message: {e}")
 
-## makes and sends packet to codekcal queue
-def on_message(channel, method, properties, body, param_queue_name, codekcal_queue_name, gw_port, item_db_uri):
-    logging.info(f"( on_message ) Received message from queue '{param_queue_name}'")
-
-    packet = process_message(body, codekcal_queue_name, gw_port, item_db_uri)
+## sends the packet to codekcal queue and acks the message once it is sent,
+## a message without a packet is requeued once and dropped if it fails again.
+## runs on the connection thread
+def finish_message(channel, method, packet, codekcal_queue_name, catalog_cache, snapshot_exchange_name):
+    sent = False
+    if packet:
+        log_packet(packet)
+        # a changed catalog is published before the first packet made on it
+        snapshot = catalog_cache.unpublished() if snapshot_exchange_name else None
+        if snapshot and publish_snapshot(channel, snapshot_exchange_name, snapshot):
+            catalog_cache.mark_published(snapshot[0])
+        sent = send_packet_to_queue(channel, codekcal_queue_name, packet)
+
+    if sent:
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+    else:
+        logging.error(f"( finish_message ) packet not sent, requeue: {not method.redelivered}")
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
 
+def log_packet(packet):
     packet_user = packet.get("user")
     packet_calories = packet.get("calories")
     packet_range = packet.get("range")
@@ -120,24 +142,65 @@ def on_message(channel, method, properties, body, param_queue_name, codekcal_que
     logging.info(
         f"( process_message ) packet_user: {type(packet_user)} packet_calories: {type(packet_calories)} packet_range: {type(packet_range)} packet_days: {type(packet_days)} packet_mealsPerDay: {type(packet_mealsPerDay)}")
 
-    if packet:
-        send_packet_to_queue(channel, codekcal_queue_name, packet)
+## makes and sends packet to codekcal queue
+def on_message(channel, method, properties, body, param_queue_name, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name):
+    logging.info(f"( on_message ) Received message from queue '{param_queue_name}'")
 
-def create_on_message_callback(param_queue_name, codekcal_queue_name, gw_port, item_db_uri):
+    packet = process_message(body, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name)
+    finish_message(channel, method, packet, codekcal_queue_name, catalog_cache, snapshot_exchange_name)
+
+## makes the packet on the thread pool, so a slow item_db only holds up one
+## worker. the packet is sent and the message acked from the connection thread
+def on_message_to_pool(channel, method, properties, body, param_queue_name, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name, connection, pool):
+    logging.info(f"( on_message_to_pool ) Received message from queue '{param_queue_name}'")
+
+    def make_packet():
+        try:
+            packet = process_message(body, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name)
+        except Exception as e:
+            logging.error(f"( on_message_to_pool ) Error processing message: {e}")
+            packet = None
+        try:
+            connection.add_callback_threadsafe(
+                functools.partial(finish_message, channel, method, packet, codekcal_queue_name, catalog_cache, snapshot_exchange_name)
+            )
+        except Exception as e:
+            logging.error(f"( on_message_to_pool ) could not finish message: {e}")
+
+    pool.submit(make_packet)
+
+def create_on_message_callback(param_queue_name, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name, connection, pool):
     logging.info(f"( create_on_message_callback )")
     def on_message_callback(ch, method, properties, body):
         logging.info(f"( on_message_callback )")
-        on_message(ch, method, properties, body, param_queue_name, codekcal_queue_name, gw_port, item_db_uri)
+        if pool:
+            on_message_to_pool(ch, method, properties, body, param_queue_name, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name, connection, pool)
+        else:
+            on_message(ch, method, properties, body, param_queue_name, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name)
     return on_message_callback
 
+## a crawl run marks the catalog stale so the next packet revalidates it
+def create_on_trigger_callback(catalog_cache):
+    def on_trigger_callback(ch, method, properties, body):
+        logging.info(f"( on_trigger_callback ) crawl trigger: {body}")
+        catalog_cache.invalidate()
+    return on_trigger_callback
+
 
 ## starts the rabbit channel as a separate thread and consumes the parameter queue
-def run_consumer(param_queue_name, codekcal_queue_name, gw_port, item_db_uri, rabbitmq_user, rabbitmq_password, rabbitmq_host):
+## worker_count = threads making packets, 0 makes them on the connection thread
+## prefetch     = unacked parameter messages held at once
+def run_consumer(param_queue_name, codekcal_queue_name, gw_port, item_db_uri, catalog_cache, trigger_exchange_name, snapshot_exchange_name, worker_count, prefetch, rabbitmq_user, rabbitmq_password, rabbitmq_host):
     if not param_queue_name or not codekcal_queue_name or not gw_port or not item_db_uri:
         logging.error("One or more required environment variables are missing. Exiting.")
         sys.exit(1)
 
+    pool = None
     try:
+        if worker_count > 0:
+            logging.info(f"( run_consumer ) starting {worker_count} packet workers")
+            pool = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix='codekcal')
+
         # Establish connection
         credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_password)
         connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host, credentials=credentials))
@@ -146,13 +209,30 @@ def run_consumer(param_queue_name, codekcal_queue_name, gw_port, item_db_uri, ra
         # Declare the parameter queue
         channel.queue_declare(queue=param_queue_name, durable=True)
 
+        # menu snapshots for the sorter
+        if snapshot_exchange_name:
+            channel.exchange_declare(exchange=snapshot_exchange_name, exchange_type='fanout', durable=True)
+
+        channel.basic_qos(prefetch_count=max(1, prefetch))
+
         # Define the callback with additional arguments
         channel.basic_consume(
             queue=param_queue_name,
-            on_message_callback=create_on_message_callback(param_queue_name, codekcal_queue_name, gw_port, item_db_uri),
-            auto_ack=True
+            on_message_callback=create_on_message_callback(param_queue_name, codekcal_queue_name, gw_port, catalog_cache, snapshot_exchange_name, connection, pool),
+            auto_ack=False
         )
 
+        # own queue on the crawl trigger exchange, dropped when codekcal stops
+        if trigger_exchange_name:
+            channel.exchange_declare(exchange=trigger_exchange_name, exchange_type='fanout', durable=True)
+            trigger_queue = channel.queue_declare(queue='', exclusive=True).method.queue
+            channel.queue_bind(exchange=trigger_exchange_name, queue=trigger_queue)
+            channel.basic_consume(
+                queue=trigger_queue,
+                on_message_callback=create_on_trigger_callback(catalog_cache),
+                auto_ack=True
+            )
+
         logging.info(f"( run_consumer ) waiting for message from {param_queue_name}")
 
         # Start consuming in a separate thread to allow graceful shutdown
@@ -170,6 +250,9 @@ def run_consumer(param_queue_name, codekcal_queue_name, gw_port, item_db_uri, ra
         logging.error(f"( run_consumer ) AMQP connection error: {e}")
     except Exception as e:
         logging.error(f"( run_consumer ) Unexpected error: {e}")
+    finally:
+        if pool:
+            pool.shutdown(wait=True)
 
 def run():
     path_flag_docker = True
@@ -193,12 +276,27 @@ def run():
     rabbitmq_password = os.getenv('RABBITMQ_PASS')
     rabbitmq_host = os.getenv('RABBITMQ_HOST')
 
+    # item catalog kept between packets
+    catalog_ttl_seconds = float(os.getenv('CATALOG_TTL_SECONDS', 300))
+    catalog_cache = CatalogCache(item_db_uri, catalog_ttl_seconds, convert_list_to_dict)
+    trigger_exchange_name = os.getenv('FANOUT_EXCHANGE_NAME')
+    logging.info(f"( run ) catalog_ttl_seconds: {catalog_ttl_seconds} trigger_exchange_name: {trigger_exchange_name}")
+
+    # packets refer to the catalog by snapshot id when set, else carry the whole catalog
+    snapshot_exchange_name = os.getenv('MENU_SNAPSHOT_EXCHANGE')
+    logging.info(f"( run ) snapshot_exchange_name: {snapshot_exchange_name}")
+
+    # packet workers and unacked messages, prefetch defaults to one per worker
+    worker_count = int(os.getenv('CODEKCAL_WORKERS', 4))
+    prefetch = int(os.getenv('CODEKCAL_PREFETCH') or max(1, worker_count))
+    logging.info(f"( run ) worker_count: {worker_count} prefetch: {prefetch}")
+
     # signal handlers
     signal.signal(signal.SIGINT, graceful_shutdown)
     signal.signal(signal.SIGTERM, graceful_shutdown)
 
     logging.info("( run ) Starting RabbitMQ consumer.")
-    run_consumer(param_queue_name, codekcal_queue_name, gw_port, item_db_uri, rabbitmq_user, rabbitmq_password, rabbitmq_host)
+    run_consumer(param_queue_name, codekcal_queue_name, gw_port, item_db_uri, catalog_cache, trigger_exchange_name, snapshot_exchange_name, worker_count, prefetch, rabbitmq_user, rabbitmq_password, rabbitmq_host)
     logging.info("( run ) Consumer stopped.")
 
 if __name__ == '__main__':
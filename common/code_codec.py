@@ -0,0 +1,43 @@
+import ast
+import json
+import logging
+
+# wire format of the item code messages (mcCode, carryCodes,
+# nonCarryCodes): a JSON array of code strings, marked by its content type.
+# bodies without the content type are the old str(list) messages and are
+# still read, so producers and consumers can be updated in any order
+
+CONTENT_TYPE = 'application/json'
+
+# prefixes the code strippers put on the codes of their brand
+META_CODES = ('mcd-', 'bgk-')
+
+def encode(codes):
+    return json.dumps([str(code) for code in codes]).encode('utf-8') # encode
+
+# the codes of a message body, content_type = properties.content_type
+def decode(body, content_type=None):
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    if content_type == CONTENT_TYPE:
+        codes = json.loads(text)
+    else:
+        codes = decode_legacy(text)
+    return [str(code).strip() for code in codes if str(code).strip()] # decode
+
+# str(list) bodies, or plain comma separated codes
+def decode_legacy(text):
+    try:
+        codes = ast.literal_eval(text)
+        if isinstance(codes, (list, tuple)):
+            return list(codes)
+    except (ValueError, SyntaxError):
+        pass
+    logging.info("( code_codec.decode_legacy ) body is not a list, splitting on ','")
+    return [code.strip().strip('[]').strip().strip('"\'') for code in text.split(',')] # decode_legacy
+
+# 'mcd-500232' -> '500232', codes without a meta code are returned as they are
+def strip_meta_code(code):
+    for meta_code in META_CODES:
+        if code.startswith(meta_code):
+            return code[len(meta_code):]
+    return code # strip_meta_code
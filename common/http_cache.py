@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import http_client
+
+# on disk cache of GET responses for sources that are fetched on every
+# crawl. a body is kept with its ETag / Last-Modified validators under
+# HTTP_CACHE_DIR, keyed by url, and sent again as a conditional request.
+# on a 304 the body is read from disk instead of downloaded. responses
+# without validators are not kept. an empty HTTP_CACHE_DIR turns the
+# cache off.
+
+def cache_dir():
+    return os.getenv('HTTP_CACHE_DIR', '')
+
+def cache_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    base = os.path.join(cache_dir(), key[:2], key)
+    return f"{base}.body", f"{base}.meta.json" # cache_paths
+
+def read_cached(url):
+    body_path, meta_path = cache_paths(url)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(body_path, 'rb') as f:
+            content = f.read()
+    except (OSError, ValueError):
+        return None, None
+    if meta.get('url') != url:
+        return None, None
+    return meta, content # read_cached
+
+def write_atomic(path, content):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+# the body is written before the meta, so a meta on disk always has its body
+def write_cached(url, response):
+    meta = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
+    if not meta['etag'] and not meta['last_modified']:
+        return
+    body_path, meta_path = cache_paths(url)
+    try:
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        write_atomic(body_path, response.content)
+        write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+    except OSError as e:
+        logging.error(f"( http_cache.write_cached ) could not cache {url}: {e}")
+
+def conditional_headers(meta):
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers # conditional_headers
+
+# the body of url, from disk when the source answers 304 Not Modified.
+# raises requests.exceptions.RequestException like response.raise_for_status
+def get_content(url, **kwargs):
+    if not cache_dir():
+        response = http_client.get(url, **kwargs)
+        response.raise_for_status()
+        return response.content
+
+    meta, content = read_cached(url)
+    headers = dict(kwargs.pop('headers', None) or {})
+    if meta:
+        headers.update(conditional_headers(meta))
+
+    response = http_client.get(url, headers=headers, **kwargs)
+    if response.status_code == 304 and content is not None:
+        logging.info(f"( http_cache.get_content ) not modified, {len(content)} bytes from cache: {url}")
+        return content
+
+    response.raise_for_status()
+    write_cached(url, response)
+    return response.content # get_content
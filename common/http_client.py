@@ -0,0 +1,69 @@
+import logging
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# shared HTTP client of the python services, copied into the src folder of
+# every service that uses it (see docker-compose.yml additional_contexts).
+# one requests.Session per process keeps connections to the gateway and the
+# menu sites alive between calls instead of opening one per request.
+# configured from the environment the first time it is used:
+# HTTP_POOL_SIZE     = connections kept per host
+# HTTP_TIMEOUT_S     = read timeout of a request, connecting gets HTTP_CONNECT_TIMEOUT_S
+# HTTP_RETRIES       = retries of failed connections and 502/503/504 answers,
+#                      POST is only retried when the connection never opened
+# HTTP_BACKOFF_S     = backoff factor between retries, doubled every retry
+
+session = None
+session_lock = threading.Lock()
+default_timeout = None
+
+def make_session(pool_size, retries, backoff):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    new_session = requests.Session()
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session # make_session
+
+def get_session():
+    global session, default_timeout
+    with session_lock:
+        if session is None:
+            pool_size = int(os.getenv('HTTP_POOL_SIZE', 10))
+            retries = int(os.getenv('HTTP_RETRIES', 3))
+            backoff = float(os.getenv('HTTP_BACKOFF_S', 0.5))
+            default_timeout = (
+                float(os.getenv('HTTP_CONNECT_TIMEOUT_S', 5)),
+                float(os.getenv('HTTP_TIMEOUT_S', 30))
+            )
+            session = make_session(pool_size, retries, backoff)
+            logging.info(f"( http_client.get_session ) pool_size: {pool_size} retries: {retries} backoff: {backoff} timeout: {default_timeout}")
+        return session # get_session
+
+# same arguments as requests.request, with the default timeout unless one is given
+def request(method, url, **kwargs):
+    client = get_session()
+    kwargs.setdefault('timeout', default_timeout)
+    return client.request(method, url, **kwargs) # request
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+# content addressed store of downloaded menu catalogs on a volume shared by
+# the services of one crawl (see menu-sources in docker-compose.yml).
+# a catalog is stored once as <MENU_SOURCE_STORE_DIR>/<source>/<sha256>.json
+# and passed between services by its ref "<source>/<sha256>", so a catalog
+# fetched by a code stripper is read by the formatter instead of downloaded
+# again. the MENU_SOURCE_KEEP newest catalogs of every source are kept.
+
+REF_PATTERN = re.compile(r'^([a-z0-9_-]+)/([0-9a-f]{64})$')
+
+def store_dir():
+    return os.getenv('MENU_SOURCE_STORE_DIR', '/data/menu_sources')
+
+def snapshot_path(source, digest):
+    return os.path.join(store_dir(), source, f"{digest}.json")
+
+# stores the raw catalog bytes of a source, returns its ref or None when
+# the store can not be written
+def put_snapshot(source, content):
+    digest = hashlib.sha256(content).hexdigest()
+    ref = f"{source}/{digest}"
+    if not REF_PATTERN.match(ref):
+        logging.error(f"( menu_source_store.put_snapshot ) bad source name: {source}")
+        return None
+
+    path = snapshot_path(source, digest)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # touched so pruning sees it as the newest
+            os.utime(path)
+        else:
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        prune(source)
+    except OSError as e:
+        logging.error(f"( menu_source_store.put_snapshot ) could not store {ref}: {e}")
+        return None
+
+    logging.info(f"( menu_source_store.put_snapshot ) stored {ref} ({len(content)} bytes)")
+    return ref # put_snapshot
+
+# the parsed catalog of a ref, None when it is not in the store or does
+# not match its hash
+def get_snapshot(ref):
+    match = REF_PATTERN.match(ref or '')
+    if not match:
+        logging.error(f"( menu_source_store.get_snapshot ) bad ref: {ref}")
+        return None
+
+    source, digest = match.groups()
+    try:
+        with open(snapshot_path(source, digest), 'rb') as f:
+            content = f.read()
+    except OSError as e:
+        logging.info(f"( menu_source_store.get_snapshot ) {ref} not in store: {e}")
+        return None
+
+    if hashlib.sha256(content).hexdigest() != digest:
+        logging.error(f"( menu_source_store.get_snapshot ) {ref} does not match its hash")
+        return None
+    return json.loads(content) # get_snapshot
+
+# drops all but the MENU_SOURCE_KEEP newest catalogs of a source
+def prune(source):
+    keep = int(os.getenv('MENU_SOURCE_KEEP', 5))
+    source_dir = os.path.join(store_dir(), source)
+    paths = [
+        os.path.join(source_dir, name)
+        for name in os.listdir(source_dir)
+        if name.endswith('.json')
+    ]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[max(1, keep):]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.error(f"( menu_source_store.prune ) could not remove {path}: {e}")
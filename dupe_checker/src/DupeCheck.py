@@ -8,6 +8,8 @@ import time
 from pika import exceptions
 import pika
 import requests
+import http_client
+import code_codec
 from dotenv import load_dotenv
 
 # global flag
@@ -25,7 +27,7 @@ logging.basicConfig(
 
 def get_codes_from_db(api_url):
     try:
-        response = requests.get(api_url)
+        response = http_client.get(api_url)
         response.raise_for_status()
 
         codes = response.json()
@@ -39,47 +41,51 @@ def get_codes_from_db(api_url):
         return []
     # get_codes_from_db
 
-## returns a list of item codes that is not in the database but is in queue
+## returns a list of item codes that is not in the database but is in queue.
+## queue codes carry a meta code (mcd-, bgk-) that database codes do not, the
+## codes keep it so the formatter can tell the brands apart
 def get_new_item_codes(queue_codes, db_codes):
-    queue_codes = queue_codes.split(',')  # Adjust the delimiter as needed
-    queue_codes = [code.strip() for code in queue_codes if code.strip()]
-    return list(set(queue_codes) - set(db_codes)) # get_new_item_codes
+    db_code_set = {str(code) for code in db_codes}
+    return [code for code in queue_codes if code_codec.strip_meta_code(code) not in db_code_set] # get_new_item_codes
 
-## returns a list of item codes that is in the queue but not in database
+## returns a list of item codes that is in the database but not in queue
 def get_non_carry_item_codes(queue_codes, db_codes):
-    return list(set(db_codes) - set(queue_codes)) # get_non_carry_item_codes
+    queue_code_set = {code_codec.strip_meta_code(code) for code in queue_codes}
+    return [str(code) for code in db_codes if str(code) not in queue_code_set] # get_non_carry_item_codes
 
-def send_codes(codes, queue_name, channel):
+## chunk_size = codes per message, so consumers can share the work. 0 sends
+## every code in one message
+def send_codes(codes, queue_name, channel, headers=None, chunk_size=0):
     logging.info(f"( send_codes ) Sending {len(codes)} codes to {queue_name} on channel {channel}")
-    stripped_codes = []
-    for code in codes:
-        if "[" in code:
-            stripped_codes.append(code.translate({ord('['):None}))
-        if "]" in code:
-            stripped_codes.append(code.translate({ord(']'):None}))
-        if "]" in code:
-            stripped_codes.append(code.translate({ord("'"):None}))
-        else:
-            stripped_codes.append(code)
-
-    str_stripped_codes = str(stripped_codes)
-    logging.info(f"( send_codes ) Sending {str_stripped_codes}")
-    channel.basic_publish(exchange='', routing_key=queue_name, body=str_stripped_codes)
+    chunk_size = chunk_size or max(1, len(codes))
+    for start in range(0, max(1, len(codes)), chunk_size):
+        chunk = codes[start:start + chunk_size]
+        logging.info(f"( send_codes ) Sending {chunk}")
+        channel.basic_publish(
+            exchange='',
+            routing_key=queue_name,
+            body=code_codec.encode(chunk),
+            properties=pika.BasicProperties(content_type=code_codec.CONTENT_TYPE, headers=headers)
+        )
 
-def create_on_message_callback(carry_code_queue, non_carry_code_queue, api_url):
+def create_on_message_callback(carry_code_queue, non_carry_code_queue, api_url, send_all_carried, chunk_size):
     logging.info(f"( create_on_message_callback ) create_on_message_callback")
     def on_message_callback(ch, method, properties, body):
         logging.info(f"( on_message_callback ) on_message_callback")
-        on_message(ch, method, properties, body, carry_code_queue, non_carry_code_queue, api_url)
+        on_message(ch, method, properties, body, carry_code_queue, non_carry_code_queue, api_url, send_all_carried, chunk_size)
     return on_message_callback
 
-def on_message(ch, method, properties, body, carry_code_queue, non_carry_code_queue, api_url):
+## send_all_carried = every code in the queue goes to the carry queue, not only
+## the new ones, so the formatter can pick up items that changed under a known
+## code. the formatter only writes the items whose fingerprint changed.
+## chunk_size = carried codes per message, spread over the formatter replicas
+def on_message(ch, method, properties, body, carry_code_queue, non_carry_code_queue, api_url, send_all_carried, chunk_size):
 
     # get codes from database and code queue
     db_codes = get_codes_from_db(api_url)
     logging.info(f"( on_message ) db_codes: {db_codes} {type(db_codes)}")
 
-    queue_codes = body.decode('utf-8')
+    queue_codes = code_codec.decode(body, properties.content_type)
     logging.info(f"( on_message ) queue_codes: {queue_codes} {type(queue_codes)}")
 
     # get lists of new and deprecated item codes
@@ -88,13 +94,20 @@ def on_message(ch, method, properties, body, carry_code_queue, non_carry_code_qu
     non_carry_item_codes = get_non_carry_item_codes(queue_codes, db_codes)
     logging.info(f"( on_message ) non_carry_item_codes: {non_carry_item_codes}")
 
-    # send codes of new items to the new item queue
-    send_codes(new_item_codes, carry_code_queue, ch)
+    # the ref of the catalog the codes came from is passed on, so the
+    # formatter reads that catalog instead of downloading it again
+    snapshot_ref = (properties.headers or {}).get('x-snapshot-ref')
+    headers = {'x-snapshot-ref': snapshot_ref} if snapshot_ref else None
+    logging.info(f"( on_message ) snapshot_ref: {snapshot_ref}")
+
+    # send codes of new items, or of every carried item, to the carry queue
+    carry_item_codes = queue_codes if send_all_carried else new_item_codes
+    send_codes(carry_item_codes, carry_code_queue, ch, headers, chunk_size)
 
     #  send codes of items no longer carried to the non carry item queue
     send_codes(non_carry_item_codes, non_carry_code_queue, ch) # on_message
 
-def run_consumer(carry_code_queue, non_carry_code_queue, code_queue_name, api_url, rabbitmq_username, rabbitmq_password, rabbitmq_host):
+def run_consumer(carry_code_queue, non_carry_code_queue, code_queue_name, api_url, send_all_carried, chunk_size, rabbitmq_username, rabbitmq_password, rabbitmq_host):
     if not carry_code_queue or not non_carry_code_queue or not code_queue_name or not api_url:
         logging.error("One or more required environment variables are missing. Exiting.")
         sys.exit(1)
@@ -112,7 +125,7 @@ def run_consumer(carry_code_queue, non_carry_code_queue, code_queue_name, api_ur
         # Define the callback with additional arguments
         channel.basic_consume(
             queue=code_queue_name,
-            on_message_callback=create_on_message_callback(carry_code_queue, non_carry_code_queue, api_url),
+            on_message_callback=create_on_message_callback(carry_code_queue, non_carry_code_queue, api_url, send_all_carried, chunk_size),
             auto_ack=True
         )
 
@@ -154,6 +167,8 @@ def run():
     rabbitmq_username = os.getenv('RABBITMQ_USERNAME')
     rabbitmq_password = os.getenv('RABBITMQ_PASSWORD')
     rabbitmq_host = os.getenv('RABBITMQ_HOST')
+    send_all_carried = os.getenv('SEND_ALL_CARRIED_CODES', 'false').lower() == 'true'
+    chunk_size = int(os.getenv('CODE_CHUNK_SIZE') or 0)
 
     # database GET request uri for all item codes
     api_url = f'http://localhost:{db_port}/api/item/codes'
@@ -163,7 +178,7 @@ def run():
     signal.signal(signal.SIGTERM, graceful_shutdown)
 
     logging.info("Starting RabbitMQ consumer.")
-    run_consumer(carry_code_queue, non_carry_code_queue, code_queue_name, api_url, rabbitmq_username, rabbitmq_password, rabbitmq_host)
+    run_consumer(carry_code_queue, non_carry_code_queue, code_queue_name, api_url, send_all_carried, chunk_size, rabbitmq_username, rabbitmq_password, rabbitmq_host)
     logging.info("Consumer stopped.")
     # run
 
@@ -2,10 +2,12 @@ import json
 import os
 import sys
 
-from urllib.request import urlopen
-
 import logging
-import requests
+import http_client
+import menu_source_store
+from item_batcher import ItemBatcher
+import fingerprint_store
+import food_classifier
 from dotenv import load_dotenv
 
 # Configure logging
@@ -18,88 +20,95 @@ logging.basicConfig(
     ]
 )
 
-def find_menu_item_data(data_obj_json, code):
-    logging.info(f"( bk_formatter.find_menu_item_data )")
-    menu_item_data = {
-        "item_id": "",
-        "item_name": "",
-        "energy_Kcal": 0,
-        "food_type": ""
-    }
-    logging.info(f"( bk_formatter.find_menu_item_data ) menu_item_data: {json.dumps(menu_item_data)}")
-    filter_list = ['kaffe', 'Espresso', 'Cappuccino', 'Milkshakes', 'drinks']
-
+# the BK catalog parsed once into externalId -> menu_item_data, with the
+# food type worked out in the same pass. an item listed in more than one
+# category keeps the first listing
+def index_menu_items(data_obj_json):
+    item_index = {}
     data = {}
     if "data" in data_obj_json:
-        logging.info(f"( bk_formatter.find_menu_item_data ) data")
         data = data_obj_json["data"]
     if "categories" in data:
-        logging.info(f"( bk_formatter.find_menu_item_data ) category")
         categories = data["categories"]
 
         for category in categories:
-            items = category["items"]
-            category_name = category.get("categoryLongName").lower()
-            for item in items:
-                if item["externalId"] in code:
-                    logging.info(f"( bk_formatter.find_menu_item_data ) externalId: {item['externalId']}")
-                    menu_item_data['item_id'] = item["externalId"]
-                    menu_item_data['item_name'] = item["productName"]
-                    string_to_float = float(item["calories"])
-                    float_to_int = int(string_to_float)
-                    menu_item_data['energy_Kcal'] = float_to_int
-
-                    item_name = item.get("productName").lower()
-
-                    if any(filter_word.lower() in item_name for filter_word in filter_list):
-                        menu_item_data['food_type'] = "drink"
-                    elif any(filter_word.lower() in category_name for filter_word in filter_list):
-                        menu_item_data['food_type'] = "drink"
-                    else:
-                        menu_item_data['food_type'] = "food"
-                    logging.info(f"( bk_formatter.find_menu_item_data ) menu_item_data: {menu_item_data}")
-                    return menu_item_data
-
-def send_data(items, api_url):
+            category_name = category.get("categoryLongName")
+            for item in category["items"]:
+                external_id = item.get("externalId")
+                if external_id in item_index:
+                    continue
+                try:
+                    item_name = item["productName"]
+                    if not isinstance(item_name, str):
+                        raise TypeError(f"productName is {type(item_name)}")
+                    food_type = food_classifier.classify('bk', item_name, category_name)
+
+                    item_index[external_id] = {
+                        "item_id": external_id,
+                        "item_name": item_name,
+                        "energy_Kcal": int(float(item["calories"])),
+                        "food_type": food_type
+                    }
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    logging.error(f"( bk_formatter.index_menu_items ) skipping item {external_id}: {e}")
+
+    logging.info(f"( bk_formatter.index_menu_items ) indexed {len(item_index)} items")
+    return item_index # index_menu_items
+
+def find_menu_item_data(item_index, code):
+    menu_item_data = item_index.get(code)
+    if menu_item_data is None:
+        logging.info(f"( bk_formatter.find_menu_item_data ) no item for code: {code}")
+    return menu_item_data # find_menu_item_data
+
+# items go to item_db in bulk requests of batch_size items
+def send_data(items, api_url, batch_size):
     if items:
-        logging.info(f"( bk_formatter.send_data ) items: {type(items)}")
+        logging.info(f"( bk_formatter.send_data ) items: {len(items)}")
+        # every item is known up front, so batches only ever fill up
+        batcher = ItemBatcher(f"{api_url}/bulk", batch_size, 60, fingerprint_store.get_store(api_url))
         for item in items:
-            try:
-                response = requests.post(api_url, json=item)
-
-                if response.status_code == 200:
-                    logging.info("( bk_formatter.send_data ) Successfully sent data to the API.")
-                    logging.info(f"( bk_formatter.send_data ) Response: {json.dumps(response.json(), indent=4)}")
-                else:
-                    logging.error(
-                        f"( bk_formatter.send_data ) Failed to send data. Status code: {response.status_code}")
-                    logging.error(f"( bk_formatter.send_data ) Response: {json.dumps(response.json(), indent=4)}")
-
-            except requests.exceptions.RequestException as e:
-                logging.error(f"( bk_formatter.send_data ) An error occurred: {e}")
+            batcher.add(item)
+        counts = batcher.close()
+        logging.info(f"( bk_formatter.send_data ) {counts}")
     else:
         logging.error(f"( bk_formatter.send_data ) empty json")
     # send_data
 
 def get_json_from_url(url):
-    response = urlopen(url)
-    return json.loads(response.read()) # get_json_from_url
+    response = http_client.get(url)
+    response.raise_for_status()
+    return response.json() # get_json_from_url
+
+# the catalog the bk stripper stored for this crawl, downloaded when the
+# codes came without a ref or the store no longer has it
+def get_bk_items(snapshot_ref, bk_url):
+    if snapshot_ref:
+        bk_items = menu_source_store.get_snapshot(snapshot_ref)
+        if bk_items is not None:
+            logging.info(f"( bk_formatter.get_bk_items ) catalog read from store: {snapshot_ref}")
+            return bk_items
+    logging.info(f"( bk_formatter.get_bk_items ) downloading catalog: {bk_url}")
+    return get_json_from_url(bk_url) # get_bk_items
 
 def test():
-    response = requests.get("http://gateway:8081/item_db/api/item/test")
+    response = http_client.get("http://gateway:8081/item_db/api/item/test")
     if response.status_code == 200:
         logging.info(f"( bk_formatter.test ) response: {response.text}")
     else:
         logging.error(f"( bk_formatter.test ) response status code: {response.status_code}")
 
-def run_sequence(bk_items, codes, api_url):
+def run_sequence(bk_items, codes, api_url, batch_size):
+    item_index = index_menu_items(bk_items)
     items = []
     for code in codes:
-        items.append(find_menu_item_data(bk_items, code))
+        menu_item_data = find_menu_item_data(item_index, code)
+        if menu_item_data:
+            items.append(menu_item_data)
 
-    send_data(items, api_url)
+    send_data(items, api_url, batch_size)
 
-def run(codes):
+def run(codes, snapshot_ref=None):
     path_flag_docker = True
     if path_flag_docker:
         load_dotenv('/app/environment/formatter.env')
@@ -126,6 +135,7 @@ def run(codes):
     logging.info(f"( bk_formatter.run ) api_url: {api_url}")
     bk_url = os.getenv('BK_URL')
     logging.info(f"( bk_formatter.run ) bk_url: {bk_url}")
-    bk_items = get_json_from_url(bk_url)
+    bk_items = get_bk_items(snapshot_ref, bk_url)
     #logging.info(f"( run ) bk_items: {json.dumps(bk_items, indent=4)}")
-    run_sequence(bk_items, codes, api_url)
+    batch_size = int(os.getenv('ITEM_BATCH_SIZE', 50))
+    run_sequence(bk_items, codes, api_url, batch_size)
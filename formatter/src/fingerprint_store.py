@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import requests
+import http_client
+
+# fields of a menu_item_data record, as item_db also returns them
+ITEM_FIELDS = ('item_id', 'item_name', 'energy_Kcal', 'food_type')
+
+# the hash of a menu_item_data record, the same for records that only
+# differ in key order, surrounding whitespace or the type of item_id
+def fingerprint(item):
+    normalized = {}
+    for key in ITEM_FIELDS:
+        value = item.get(key)
+        if key == 'item_id' and value is not None:
+            value = str(value)
+        normalized[key] = value.strip() if isinstance(value, str) else value
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest() # fingerprint
+
+# hashes of the items item_db holds, so an item is only written when item_db
+# does not have it or has an older record of it. the hashes are read from
+# item_db once and kept for ttl_s seconds, so every chunk of a crawl shares
+# one read while items the item remover deleted or item_db lost are written
+# again by the next crawl. when item_db can not be read every item counts
+# as changed until the next read.
+# items_url = item_db endpoint of every item, through the gateway
+# ttl_s     = seconds a read of item_db is used
+class FingerprintStore:
+    def __init__(self, items_url, ttl_s):
+        self.items_url = items_url
+        self.ttl_s = ttl_s
+        self.fingerprints = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl_s
+
+    # one thread reads item_db, the others wait for its read. self.lock is
+    # not held during the request
+    def refresh(self):
+        with self.load_lock:
+            with self.lock:
+                if not self.stale():
+                    return
+            try:
+                response = http_client.get(self.items_url)
+                response.raise_for_status()
+                fingerprints = {str(item.get('item_id')): fingerprint(item) for item in response.json()}
+                logging.info(f"( FingerprintStore.refresh ) {len(fingerprints)} items in item_db")
+            except (requests.exceptions.RequestException, ValueError, TypeError, AttributeError) as e:
+                logging.error(f"( FingerprintStore.refresh ) could not read item_db, writing every item: {e}")
+                fingerprints = None
+            with self.lock:
+                self.fingerprints = fingerprints
+                self.loaded_at = time.monotonic()
+
+    def changed(self, item):
+        with self.lock:
+            stale = self.stale()
+        if stale:
+            self.refresh()
+        with self.lock:
+            if self.fingerprints is None:
+                return True
+            return self.fingerprints.get(str(item.get('item_id'))) != fingerprint(item)
+
+    # called once items are stored in item_db
+    def remember(self, items):
+        with self.lock:
+            if self.fingerprints is not None:
+                for item in items:
+                    self.fingerprints[str(item.get('item_id'))] = fingerprint(item)
+
+stores = {}
+stores_lock = threading.Lock()
+
+# the store of items_url for the whole formatter, shared by every chunk and
+# brand. None when SKIP_UNCHANGED_ITEMS is off, which writes every item
+def get_store(items_url):
+    if os.getenv('SKIP_UNCHANGED_ITEMS', 'true').lower() != 'true':
+        return None
+    with stores_lock:
+        if items_url not in stores:
+            ttl_s = float(os.getenv('FINGERPRINT_TTL_S', 600))
+            stores[items_url] = FingerprintStore(items_url, ttl_s)
+        return stores[items_url] # get_store
@@ -0,0 +1,79 @@
+import functools
+import json
+import logging
+import os
+import re
+import threading
+
+# drink / food classification shared by the brand formatters. the rules of a
+# brand are the words that make an item a drink when found in its category
+# or its name, case insensitive. the words of a rule are compiled into one
+# regex, and results are cached per (brand, name, category).
+# FOOD_RULES_PATH can point to a JSON file of rules in the form of
+# DEFAULT_RULES, which then replaces them
+
+DEFAULT_RULES = {
+    'bk': {
+        'category': ['kaffe', 'Espresso', 'Cappuccino', 'Milkshakes', 'drinks'],
+        'name': ['kaffe', 'Espresso', 'Cappuccino', 'Milkshakes', 'drinks']
+    },
+    'mcd': {
+        'category': ['drikk'],
+        'name': ['McCafé', 'McCafe']
+    }
+}
+
+def compile_words(words):
+    if not words:
+        return None
+    # longest first, so a word is not cut short by a word it starts with
+    alternatives = sorted({word.lower() for word in words}, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(word) for word in alternatives)) # compile_words
+
+def load_rules():
+    path = os.getenv('FOOD_RULES_PATH', '')
+    if not path:
+        return DEFAULT_RULES
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+        logging.info(f"( food_classifier.load_rules ) rules for {list(rules)} from {path}")
+        return rules
+    except (OSError, ValueError) as e:
+        logging.error(f"( food_classifier.load_rules ) could not load {path}, using the default rules: {e}")
+        return DEFAULT_RULES
+
+# rules = brand -> {'category': [words], 'name': [words]}
+class FoodClassifier:
+    def __init__(self, rules, cache_size=4096):
+        self.matchers = {
+            brand: (compile_words(rule.get('category')), compile_words(rule.get('name')))
+            for brand, rule in rules.items()
+        }
+        self.classify = functools.lru_cache(maxsize=cache_size)(self.match)
+
+    # "drink" or "food", name and category can be None when not known
+    def match(self, brand, name, category):
+        if brand not in self.matchers:
+            logging.error(f"( FoodClassifier.match ) no rules for brand: {brand}")
+            return "food"
+        category_matcher, name_matcher = self.matchers[brand]
+        if category and category_matcher and category_matcher.search(category.lower()):
+            return "drink"
+        if name and name_matcher and name_matcher.search(name.lower()):
+            return "drink"
+        return "food"
+
+classifier = None
+classifier_lock = threading.Lock()
+
+# the classifier of the formatter, made from the rules on first use
+def get_classifier():
+    global classifier
+    with classifier_lock:
+        if classifier is None:
+            classifier = FoodClassifier(load_rules())
+        return classifier # get_classifier
+
+def classify(brand, name, category=None):
+    return get_classifier().classify(brand, name, category) # classify
@@ -0,0 +1,99 @@
+import logging
+import threading
+import requests
+import http_client
+
+# collects formatted items and stores them through the item_db bulk
+# endpoint, a batch is sent once it holds max_items items or its first item
+# has waited max_wait_s seconds, whichever comes first. add() can be called
+# from several threads, batches are sent outside the lock.
+# bulk_url     = item_db bulk endpoint through the gateway
+# max_items    = items sent in one request
+# max_wait_s   = seconds an item waits for its batch to fill
+# fingerprints = FingerprintStore, items item_db already holds unchanged are
+#                skipped. None sends every item
+class ItemBatcher:
+    def __init__(self, bulk_url, max_items, max_wait_s, fingerprints=None):
+        self.bulk_url = bulk_url
+        self.max_items = max(1, max_items)
+        self.max_wait_s = max_wait_s
+        self.fingerprints = fingerprints
+        self.items = []
+        self.timer = None
+        self.lock = threading.Lock()
+        # batches taken but not sent yet, close() waits for them
+        self.in_flight = 0
+        self.sent = threading.Condition(self.lock)
+        self.counts = {'stored': 0, 'store_failed': 0, 'unchanged': 0, 'requests': 0}
+
+    def add(self, item):
+        if self.fingerprints is not None and not self.fingerprints.changed(item):
+            with self.lock:
+                self.counts['unchanged'] += 1
+            return
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) >= self.max_items:
+                batch = self.take()
+            else:
+                batch = None
+                if self.timer is None:
+                    self.timer = threading.Timer(self.max_wait_s, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        if batch:
+            self.send(batch)
+
+    # the current batch, called with the lock held. a batch taken is in
+    # flight until send() is done with it
+    def take(self):
+        batch = self.items
+        self.items = []
+        if batch:
+            self.in_flight += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def flush(self):
+        with self.lock:
+            batch = self.take()
+        if batch:
+            self.send(batch)
+
+    def send(self, batch):
+        stored = False
+        try:
+            stored = self.post(batch)
+        finally:
+            with self.lock:
+                self.counts['requests'] += 1
+                self.counts['stored' if stored else 'store_failed'] += len(batch)
+                self.in_flight -= 1
+                self.sent.notify_all()
+        return stored
+
+    def post(self, batch):
+        stored = False
+        try:
+            response = http_client.post(self.bulk_url, json=batch)
+            if response.status_code == 200:
+                logging.info(f"( ItemBatcher.post ) stored {len(batch)} items")
+                stored = True
+                if self.fingerprints is not None:
+                    self.fingerprints.remember(batch)
+            else:
+                logging.error(f"( ItemBatcher.post ) Failed to send {len(batch)} items. Status code: {response.status_code}")
+                logging.error(f"( ItemBatcher.post ) Response: {response.text}")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"( ItemBatcher.post ) An error occurred: {e}")
+        return stored
+
+    # sends what is left, waits for batches a timer or another thread is
+    # still sending and returns the outcome counters
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.sent.wait_for(lambda: self.in_flight == 0)
+            return dict(self.counts)
@@ -3,12 +3,15 @@ import signal
 import sys
 import threading
 import time
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from pika import exceptions
 import pika
 import os
 from dotenv import load_dotenv
 import bk_formatter, mcd_formatter
+import code_codec
 
 # global flag
 shutdown_flag = threading.Event()
@@ -28,19 +31,7 @@ logging.basicConfig(
 # bgk-4835-fsd4123-324f -> 4835-fsd4123-324f
 def sort_codes(codes, meta_code):
     logging.info(f"( sort_codes {meta_code})")
-    trimmed_codes = []
-
-    for code in codes:
-        logging.info(f"( sort_codes {code})")
-        if meta_code in code:
-            trimmed_code = code.replace(meta_code, '')
-            trimmed_code = trimmed_code.replace("]", '')
-            trimmed_code = trimmed_code.replace("[", '')
-            trimmed_code = trimmed_code.replace("'", '')
-            trimmed_code = trimmed_code.replace("/", '')
-            trimmed_code = trimmed_code.replace("\\", '')
-            logging.info(f"( trimmed_code {trimmed_code})")
-            trimmed_codes.append(trimmed_code)
+    trimmed_codes = [code[len(meta_code):] for code in codes if code.startswith(meta_code)]
 
     logging.info(f"( sort_codes ) result_list: {trimmed_codes}")
     return trimmed_codes
@@ -50,25 +41,77 @@ def graceful_shutdown(signal, frame):
     shutdown_flag.set()
     logging.info(f"Signal {signal} received. Shutting down.")
 
-def on_message(channel, method, properties, body):
+# runs the pipeline of one brand, an error stops only that brand
+def run_brand(brand, brand_run, *args):
+    start = time.monotonic()
+    try:
+        brand_run(*args)
+        logging.info(f"( run_brand ) {brand} done in {time.monotonic() - start:.1f}s")
+        return True
+    except Exception as e:
+        logging.error(f"( run_brand ) {brand} failed after {time.monotonic() - start:.1f}s: {e}")
+        return False
+    # run_brand
+
+# the brands fetch from different hosts, so their pipelines run side by side
+# in brand_pool and the message takes as long as the slowest brand.
+# returns True when every brand ran
+def on_message(channel, method, properties, body, brand_pool):
     # sorts codes by meta code
-    bytes_to_string = body.decode()
-    string_to_list = bytes_to_string.split(",")
+    string_to_list = code_codec.decode(body, properties.content_type)
     logging.info(f"( on_message ) queue_codes: {type(string_to_list)} {string_to_list}")
 
+    # ref of the catalog the bk stripper fetched for this crawl
+    snapshot_ref = (properties.headers or {}).get('x-snapshot-ref')
+    logging.info(f"( on_message ) snapshot_ref: {snapshot_ref}")
+
     # calls the formatter modules
+    start = time.monotonic()
+    brand_runs = []
+
     logging.info(f"( run_consumer ) bk_formatter 'bkg-'")
     bk_codes = sort_codes(string_to_list, "bgk-")
     if len(bk_codes) > 0:
-        bk_formatter.run(bk_codes)
+        brand_runs.append(brand_pool.submit(run_brand, 'bk', bk_formatter.run, bk_codes, snapshot_ref))
 
     logging.info(f"( run_consumer ) mcd_formatter 'mcd-'")
     mcd_codes = sort_codes(string_to_list, "mcd-")
     if len(mcd_codes) > 0:
-        mcd_formatter.run(mcd_codes)
-    # on_message
+        brand_runs.append(brand_pool.submit(run_brand, 'mcd', mcd_formatter.run, mcd_codes))
 
-def run_consumer(carry_code_queue, rabbitmq_username, rabbitmq_password, rabbitmq_host):
+    wait(brand_runs)
+    logging.info(f"( on_message ) {len(brand_runs)} brands in {time.monotonic() - start:.1f}s")
+    return all(brand_run.result() for brand_run in brand_runs) # on_message
+
+# acks a processed chunk, a failed one is requeued once
+def finish_message(channel, method, processed):
+    if processed:
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+    else:
+        logging.error(f"( finish_message ) chunk failed, requeue: {not method.redelivered}")
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
+    # finish_message
+
+# every code chunk is processed on chunk_pool, so up to prefetch chunks run at
+# once and the connection keeps its heartbeats. the message is acked from the
+# connection thread
+def on_message_to_pool(channel, method, properties, body, brand_pool, connection, chunk_pool):
+    def process_chunk():
+        try:
+            processed = on_message(channel, method, properties, body, brand_pool)
+        except Exception as e:
+            logging.error(f"( on_message_to_pool ) Error processing chunk: {e}")
+            processed = False
+        try:
+            connection.add_callback_threadsafe(functools.partial(finish_message, channel, method, processed))
+        except Exception as e:
+            logging.error(f"( on_message_to_pool ) could not finish message: {e}")
+
+    chunk_pool.submit(process_chunk)
+    # on_message_to_pool
+
+# prefetch = code chunks one formatter works on at once
+def run_consumer(carry_code_queue, prefetch, rabbitmq_username, rabbitmq_password, rabbitmq_host):
     if not carry_code_queue:
         logging.error("One or more required environment variables are missing. Exiting.")
         sys.exit(1)
@@ -80,16 +123,22 @@ def run_consumer(carry_code_queue, rabbitmq_username, rabbitmq_password, rabbitm
         connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host, credentials=credentials))
         channel = connection.channel()
 
+        # one worker per chunk, and one per brand pipeline of every chunk
+        prefetch = max(1, prefetch)
+        chunk_pool = ThreadPoolExecutor(max_workers=prefetch)
+        brand_pool = ThreadPoolExecutor(max_workers=2 * prefetch)
+
         # Declare the parameter queue
         channel.queue_declare(queue=carry_code_queue, durable=True)
+        channel.basic_qos(prefetch_count=prefetch)
 
         # Define the callback with additional arguments
         channel.basic_consume(
             queue=carry_code_queue,
-            on_message_callback=lambda ch, method, properties, body: on_message(
-                ch, method, properties, body
+            on_message_callback=lambda ch, method, properties, body: on_message_to_pool(
+                ch, method, properties, body, brand_pool, connection, chunk_pool
             ),
-            auto_ack=True
+            auto_ack=False
         )
 
         logging.info(f"waiting for message from {carry_code_queue}")
@@ -103,6 +152,8 @@ def run_consumer(carry_code_queue, rabbitmq_username, rabbitmq_password, rabbitm
 
         channel.stop_consuming()
         consume_thread.join()
+        chunk_pool.shutdown(wait=True)
+        brand_pool.shutdown(wait=True)
         connection.close()
         logging.info("RabbitMQ consumer has been shut down gracefully.")
 
@@ -123,13 +174,14 @@ def run():
     rabbitmq_username = os.getenv('RABBITMQ_USERNAME')
     rabbitmq_password = os.getenv('RABBITMQ_PASSWORD')
     rabbitmq_host = os.getenv('RABBITMQ_HOST')
+    prefetch = int(os.getenv('FORMATTER_PREFETCH', 2))
 
     # signal handlers
     signal.signal(signal.SIGINT, graceful_shutdown)
     signal.signal(signal.SIGTERM, graceful_shutdown)
 
     logging.info("( run ) Starting RabbitMQ consumer.")
-    run_consumer(carry_code_queue, rabbitmq_username, rabbitmq_password, rabbitmq_host)
+    run_consumer(carry_code_queue, prefetch, rabbitmq_username, rabbitmq_password, rabbitmq_host)
     logging.info("( run ) Consumer stopped.")
 
 if __name__ == '__main__':
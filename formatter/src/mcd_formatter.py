@@ -1,9 +1,16 @@
+import asyncio
 import json
 import os
 import logging
 import sys
+import threading
+import time
+from urllib.parse import urlsplit
 import requests
-from urllib.request import urlopen
+import http_cache
+from item_batcher import ItemBatcher
+import fingerprint_store
+import food_classifier
 from dotenv import load_dotenv
 
 # Configure logging
@@ -24,8 +31,6 @@ def find_menu_item_data(json_data):
         "food_type": ""
     }
 
-    filter_list = ['McCafé', 'McCafe']
-
     if "item" in json_data:
         item = json_data["item"]
         logging.info(f"( mcd_formatter.find_menu_item_data ) item")
@@ -33,17 +38,10 @@ def find_menu_item_data(json_data):
             logging.info(f"( mcd_formatter.find_menu_item_data ) default_category")
             if "category" not in item["default_category"]:
                 logging.info(f"( mcd_formatter.find_menu_item_data ) category")
-                item_name = item.get("item_name").lower()
-                if any(filter_word.lower() in item_name for filter_word in filter_list):
-                    food_type = "drink"
-                else:
-                    food_type = "food"
-
-                menu_item_data["food_type"] = food_type
+                menu_item_data["food_type"] = food_classifier.classify('mcd', item.get("item_name"))
             elif "category" in item["default_category"]:
                 category = item["default_category"]["category"]["name"]
-                food_type = "drink" if "drikk" in category.lower() else "food"
-                menu_item_data["food_type"] = food_type
+                menu_item_data["food_type"] = food_classifier.classify('mcd', None, category)
 
         if "item_name" in item:
             menu_item_data["item_name"] = item["item_name"]
@@ -65,54 +63,91 @@ def find_menu_item_data(json_data):
     logging.info(f"( mcd_formatter.find_menu_item_data ) menu_item_data: {json.dumps(menu_item_data, indent=4)}")
     return menu_item_data # find_menu_item_data
 
-def send_data(data, api_url):
-    menu_item_data_formatted = find_menu_item_data(data)
-
-    if menu_item_data_formatted:
-        logging.info(json.dumps(menu_item_data_formatted, indent=4))
-        try:
-            response = requests.post(api_url, json=menu_item_data_formatted)
-
-            if response.status_code == 200:
-                logging.info("( mcd_formatter.send_data ) Successfully sent data to the API.")
-                logging.info(f"( mcd_formatter.send_data ) Response: {response.json()}")
-            else:
-                logging.info(f"( mcd_formatter.send_data ) Failed to send data. Status code: {response.status_code}")
-                logging.info(f"( mcd_formatter.send_data ) Response: {response.text}")
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"( mcd_formatter.send_data ) An error occurred: {e}")
-    else:
-        logging.info("( mcd_formatter.send_data ) empty json")
-
-    # send_data
-
 def make_urls_from_codes(codes, mc_url):
-    urls = []
-
-    for code in codes:
-        trimmed_code = code.replace("]", '')
-        trimmed_code = trimmed_code.replace("[", '')
-        trimmed_code = trimmed_code.replace("/", '')
-        trimmed_code = trimmed_code.replace("\\", '')
-        trimmed_code = trimmed_code.replace('"', '')
-        trimmed_code = trimmed_code.replace(' ', '')
-        urls.append(f"{mc_url}{trimmed_code}")
+    urls = [f"{mc_url}{code}" for code in codes]
 
     logging.info(f"( mcd_formatter.make_urls_from_codes ) url: {urls}")
     return urls # make_urls_from_codes
 
 def get_json_from_url(url):
     try:
-        response = urlopen(url)
-        return json.loads(response.read())  # get_json_from_url
-    except logging.error as e:
+        return json.loads(http_cache.get_content(url))  # get_json_from_url
+    except (requests.exceptions.RequestException, ValueError) as e:
         logging.error(f"( mcd_formatter.get_json_from_url ) error: {e}")
 
-def send_to_db(urls, api_url):
-    for url in urls:
-        url_json_object = get_json_from_url(url)
-        send_data(url_json_object, api_url)
+# spaces out the requests to every host to at most rate_per_second,
+# 0 is no limit
+class HostRateLimiter:
+    def __init__(self, rate_per_second):
+        self.interval = 1 / rate_per_second if rate_per_second > 0 else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    # waits for the next free slot of the host of url. chunks run their own
+    # event loops on their own threads, so slots are handed out under a lock
+    async def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# one limiter per rate for the whole formatter, so the chunks it works on at
+# once share the rate of a host instead of each getting the full rate
+def get_rate_limiter(rate_per_host):
+    with rate_limiters_lock:
+        if rate_per_host not in rate_limiters:
+            rate_limiters[rate_per_host] = HostRateLimiter(rate_per_host)
+        return rate_limiters[rate_per_host] # get_rate_limiter
+
+# fetch -> find_menu_item_data -> batch of one item. the blocking calls run
+# in worker threads, so up to max_in_flight items are underway at once.
+# counts = outcome counters shared by every item
+async def process_url(url, batcher, in_flight, limiter, counts):
+    async with in_flight:
+        await limiter.wait(url)
+        url_json_object = await asyncio.to_thread(get_json_from_url, url)
+        if not url_json_object:
+            counts['fetch_failed'] += 1
+            return
+
+        menu_item_data = find_menu_item_data(url_json_object)
+        await asyncio.to_thread(batcher.add, menu_item_data)
+    # process_url
+
+async def send_all(urls, api_url, max_in_flight, rate_per_host, batch_size, batch_wait_s):
+    in_flight = asyncio.Semaphore(max(1, max_in_flight))
+    limiter = get_rate_limiter(rate_per_host)
+    batcher = ItemBatcher(f"{api_url}/bulk", batch_size, batch_wait_s, fingerprint_store.get_store(api_url))
+    counts = {'fetch_failed': 0, 'errors': 0}
+
+    results = await asyncio.gather(
+        *(process_url(url, batcher, in_flight, limiter, counts) for url in urls),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"( mcd_formatter.send_all ) error: {result}")
+            counts['errors'] += 1
+    counts.update(await asyncio.to_thread(batcher.close))
+    return counts # send_all
+
+# items are fetched concurrently and stored in batches as they come in
+# max_in_flight = items underway at once
+# rate_per_host = requests started per second on one host, 0 is no limit
+# batch_size    = items stored in one bulk request
+# batch_wait_s  = seconds a fetched item waits for its batch to fill
+def send_to_db(urls, api_url, max_in_flight, rate_per_host, batch_size, batch_wait_s):
+    start = time.monotonic()
+    counts = asyncio.run(send_all(urls, api_url, max_in_flight, rate_per_host, batch_size, batch_wait_s))
+    logging.info(f"( mcd_formatter.send_to_db ) {len(urls)} urls in {time.monotonic() - start:.1f}s: {counts}")
+    return counts # send_to_db
 
 
 def run(codes):
@@ -139,7 +174,12 @@ def run(codes):
 
     mcd_url = os.getenv('MCD_URL')
 
+    max_in_flight = int(os.getenv('MCD_MAX_IN_FLIGHT', 16))
+    rate_per_host = float(os.getenv('MCD_RATE_PER_HOST', 10))
+    batch_size = int(os.getenv('ITEM_BATCH_SIZE', 50))
+    batch_wait_s = float(os.getenv('ITEM_BATCH_WAIT_S', 2))
+
     urls = make_urls_from_codes(codes, mcd_url)
-    send_to_db(urls, api_url)
+    send_to_db(urls, api_url, max_in_flight, rate_per_host, batch_size, batch_wait_s)
 
     # run
\ No newline at end of file
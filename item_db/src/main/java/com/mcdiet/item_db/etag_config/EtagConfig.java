@@ -0,0 +1,20 @@
+package com.mcdiet.item_db.etag_config;
+
+import org.springframework.boot.web.servlet.FilterRegistrationBean;
+import org.springframework.context.annotation.Bean;
+import org.springframework.context.annotation.Configuration;
+import org.springframework.web.filter.ShallowEtagHeaderFilter;
+
+@Configuration
+public class EtagConfig {
+
+    // ETag on the codecal catalog so codekcal can revalidate it with If-None-Match
+    // and get a 304 without a body while the catalog is unchanged
+    @Bean
+    public FilterRegistrationBean<ShallowEtagHeaderFilter> codecalEtagFilter() {
+        FilterRegistrationBean<ShallowEtagHeaderFilter> registration = new FilterRegistrationBean<>(new ShallowEtagHeaderFilter());
+        registration.addUrlPatterns("/api/item/codecal");
+        registration.setName("codecalEtagFilter");
+        return registration;
+    }
+}
@@ -56,6 +56,11 @@ public class ItemController {
         return itemService.saveItem(item);
     }
 
+    @PostMapping("/bulk")
+    public List<Item> createItems(@RequestBody List<Item> items) {
+        return itemService.saveItems(items);
+    }
+
     /* DELETE mappings */
 
     @DeleteMapping("/codes/{code}")
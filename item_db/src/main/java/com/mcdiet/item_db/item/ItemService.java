@@ -1,5 +1,6 @@
 package com.mcdiet.item_db.item;
 
+import jakarta.transaction.Transactional;
 import org.springframework.beans.factory.annotation.Autowired;
 import org.springframework.data.domain.PageRequest;
 import org.springframework.stereotype.Service;
@@ -44,4 +45,11 @@ public class ItemService {
     public Item saveItem(Item item) throws IOException, TimeoutException {
         return itemRepo.save(item);
     }
+
+    // items are keyed by item_id, so a known item is updated and a new one
+    // inserted, all in one transaction
+    @Transactional
+    public List<Item> saveItems(List<Item> items) {
+        return itemRepo.saveAll(items);
+    }
 }
\ No newline at end of file
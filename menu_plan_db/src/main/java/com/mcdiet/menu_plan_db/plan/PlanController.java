@@ -1,6 +1,7 @@
 package com.mcdiet.menu_plan_db.plan;
 
 import com.mcdiet.menu_plan_db.plan.documents.DietPlan;
+import com.mcdiet.menu_plan_db.plan.documents.Plan;
 import org.springframework.beans.factory.annotation.Autowired;
 import org.springframework.stereotype.Controller;
 import org.springframework.web.bind.annotation.*;
@@ -23,6 +24,14 @@ public class PlanController {
         return planService.saveDietPlan(plan);
     }
 
+    // appends days to a stored plan, used by the sorter to store long plans in chunks
+    // complete=false marks a plan the sorter could not finish in time
+    @PostMapping("/{id}/days")
+    public void appendDays(@PathVariable String id, @RequestBody List<Plan> days,
+                           @RequestParam(required = false) Boolean complete) {
+        planService.appendDays(id, days, complete);
+    }
+
     @GetMapping("/user")
     public DietPlan getPlanById(@RequestParam String userId) {
         return planService.getDietPlanById(userId);
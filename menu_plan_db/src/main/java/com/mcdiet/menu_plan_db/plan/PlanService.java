@@ -1,16 +1,28 @@
 package com.mcdiet.menu_plan_db.plan;
 
 import com.mcdiet.menu_plan_db.plan.documents.DietPlan;
+import com.mcdiet.menu_plan_db.plan.documents.Plan;
+import com.mongodb.client.result.UpdateResult;
 import org.springframework.beans.factory.annotation.Autowired;
+import org.springframework.data.mongodb.core.MongoTemplate;
+import org.springframework.data.mongodb.core.query.Criteria;
+import org.springframework.data.mongodb.core.query.Query;
+import org.springframework.data.mongodb.core.query.Update;
+import org.springframework.http.HttpStatus;
 import org.springframework.stereotype.Service;
+import org.springframework.web.server.ResponseStatusException;
+
+import java.util.List;
 
 @Service
 public class PlanService {
     private final PlanRepo planRepo;
+    private final MongoTemplate mongoTemplate;
 
     @Autowired
-    public PlanService(final PlanRepo planRepo) {
+    public PlanService(final PlanRepo planRepo, final MongoTemplate mongoTemplate) {
         this.planRepo = planRepo;
+        this.mongoTemplate = mongoTemplate;
     }
 
     public DietPlan saveDietPlan(DietPlan plan) {
@@ -21,4 +33,18 @@ public class PlanService {
         return planRepo.findByUser(user);
     }
 
+    // $push the days onto the plan array without loading the stored plan
+    public void appendDays(String id, List<Plan> days, Boolean complete) {
+        Query query = Query.query(Criteria.where("_id").is(id));
+        Update update = new Update().push("plan").each(days.toArray());
+        if (complete != null) {
+            update.set("complete", complete);
+        }
+        UpdateResult result = mongoTemplate.updateFirst(query, update, DietPlan.class);
+
+        if (result.getMatchedCount() == 0) {
+            throw new ResponseStatusException(HttpStatus.NOT_FOUND, "no plan with id " + id);
+        }
+    }
+
 }
@@ -23,6 +23,7 @@ public class DietPlan {
     private Integer range;
     private Integer days;
     private Integer mealsPerDay; // Adjusted to camelCase
+    private Boolean complete; // false when the sorter ran out of time before every day was made
 
     private List<Plan> plan;
 
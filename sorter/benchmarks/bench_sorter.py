@@ -0,0 +1,173 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+SORTER_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+# shared modules the docker image copies into src
+COMMON_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common')
+sys.path.insert(0, SORTER_SRC)
+sys.path.insert(1, COMMON_SRC)
+
+import numpy as np
+import sorter
+
+# share of drinks on the McDonald's + Burger King menus
+DRINK_SHARE = 0.25
+
+# makes a packet shaped like the one codekcal puts on CODE_KCAL_QUEUE,
+# half McDonald's style numeric codes and half Burger King style ids
+def make_packet(item_count, calories, kcal_range, days, meals_per_day, rng):
+    packet = {}
+    for i in range(item_count):
+        if i % 2:
+            item_id = str(rng.randint(100000, 999999))
+        else:
+            item_id = str(uuid.UUID(int=rng.getrandbits(128)))
+
+        if rng.random() < DRINK_SHARE:
+            # water and diet sodas down to milkshakes
+            energy_kcal = rng.choice([0, 0, 1, 5]) if rng.random() < 0.2 else rng.randint(40, 550)
+            food_type = 'drink'
+        else:
+            # sauces and sides up to the big burgers
+            energy_kcal = int(min(1200, rng.lognormvariate(5.6, 0.6)))
+            food_type = 'food'
+
+        packet[item_id] = {'energyKcal': energy_kcal, 'foodType': food_type}
+
+    packet.update({
+        'user': 'bench',
+        'calories': calories,
+        'range': kcal_range,
+        'days': days,
+        'mealsPerDay': meals_per_day
+    })
+    return packet # make_packet
+
+# runs fn once for its time and once under tracemalloc for its peak memory
+def measure(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+
+    del result
+    tracemalloc.start()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / (1024 * 1024) # measure
+
+def make_pool(packet, sample_size):
+    kcal_range = packet['range']
+    calories = packet['calories']
+    meals_per_day = packet['mealsPerDay']
+    if sample_size > 0:
+        return sorter.sample_meals(packet, kcal_range, calories, meals_per_day, sample_size)
+    return sorter.make_meals(packet, kcal_range, calories, meals_per_day)
+
+def run_grid(args):
+    results = []
+    grid = itertools.product(args.items, args.calories, args.range, args.meals_per_day)
+    for item_count, calories, kcal_range, meals_per_day in grid:
+        rng = random.Random(args.seed + item_count)
+        packet = make_packet(item_count, calories, kcal_range, max(args.days), meals_per_day, rng)
+
+        random.seed(args.seed)
+        meals, meals_seconds, meals_peak = measure(make_pool, packet, args.sample_size)
+
+        for days in args.days:
+            random.seed(args.seed)
+            Di_min = calories - (kcal_range / 2)
+            Di_max = calories + (kcal_range / 2)
+            calendar_days, days_seconds, days_peak = measure(
+                sorter.make_days, meals, days, meals_per_day, Di_min, Di_max
+            )
+            result = {
+                'items': item_count,
+                'calories': calories,
+                'range': kcal_range,
+                'mealsPerDay': meals_per_day,
+                'days': days,
+                'meals': len(meals),
+                'daysMade': len(calendar_days),
+                'makeMealsSeconds': round(meals_seconds, 6),
+                'makeMealsPeakMb': round(meals_peak, 3),
+                'makeDaysSeconds': round(days_seconds, 6),
+                'makeDaysPeakMb': round(days_peak, 3)
+            }
+            print(json.dumps(result))
+            results.append(result)
+    return results # run_grid
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=SORTER_SRC
+        ).stdout.strip()
+    except OSError:
+        return ''
+
+# prints the time and memory ratio of every case found in both files
+def compare(baseline_path, report):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    case = lambda r: (r['items'], r['calories'], r['range'], r['mealsPerDay'], r['days'])
+    old_results = {case(r): r for r in baseline['results']}
+    print(f"compared to {baseline.get('commit') or baseline_path}")
+    for result in report['results']:
+        old = old_results.get(case(result))
+        if not old:
+            continue
+        ratios = {
+            key: round(result[key] / old[key], 2) if old[key] else None
+            for key in ('makeMealsSeconds', 'makeMealsPeakMb', 'makeDaysSeconds', 'makeDaysPeakMb')
+        }
+        print(f"{case(result)} {ratios}")
+
+def main():
+    parser = argparse.ArgumentParser(description='time and memory of sorter.make_meals and sorter.make_days')
+    parser.add_argument('--items', type=int, nargs='+', default=[50, 200, 500, 1000])
+    parser.add_argument('--calories', type=int, nargs='+', default=[1800, 2500])
+    parser.add_argument('--range', type=int, nargs='+', default=[100, 300])
+    parser.add_argument('--meals-per-day', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--days', type=int, nargs='+', default=[7, 30])
+    parser.add_argument('--sample-size', type=int, default=200000,
+                        help='meals kept by sample_meals, 0 times make_meals instead')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_sorter.json')
+    parser.add_argument('--compare', help='earlier output file to compare against')
+    args = parser.parse_args()
+
+    # keep the sorter quiet while timing it
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        'commit': git_commit(),
+        'createdAt': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sampleSize': args.sample_size,
+        'seed': args.seed,
+        'results': run_grid(args)
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"wrote {len(report['results'])} results to {args.output}")
+
+    if args.compare:
+        compare(args.compare, report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import logging
+import random
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# pools of ready made days per (calories, range, mealsPerDay) bucket of the
+# current menu snapshot. a plan for a banked bucket is drawn from its pool
+# instead of running make_meals and make_days.
+# days_per_bucket = days made for every bucket
+# max_buckets     = buckets kept, least recently used ones are evicted
+# popular_buckets = most requested buckets, only these are banked
+# min_requests    = requests a bucket needs before it is banked
+class DayBank:
+    def __init__(self, days_per_bucket, max_buckets, popular_buckets, min_requests):
+        self.days_per_bucket = days_per_bucket
+        self.max_buckets = max_buckets
+        self.popular_buckets = popular_buckets
+        self.min_requests = min_requests
+        self.snapshot = None
+        self.banks = OrderedDict()
+        self.pending = set()
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.filler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='day_bank')
+
+    def enabled(self):
+        return self.max_buckets > 0 and self.days_per_bucket > 0
+
+    # the most requested buckets with at least min_requests requests,
+    # called with the lock held
+    def most_popular(self):
+        return [bucket for bucket, count in self.requests.most_common(self.popular_buckets) if count >= self.min_requests]
+
+    # halves the request counts and forgets buckets that drop to 0, so the
+    # counter holds the recent requests and a bounded number of buckets.
+    # called with the lock held
+    def decay(self):
+        counts = {bucket: count // 2 for bucket, count in self.requests.items() if count // 2}
+        self.requests = Counter(counts)
+        limit = self.max_buckets * 4
+        if len(self.requests) > limit:
+            self.requests = Counter(dict(self.requests.most_common(limit)))
+
+    # a bucket popular enough to be banked
+    def popular(self, bucket):
+        if not self.enabled():
+            return False
+        with self.lock:
+            return bucket in self.most_popular() # popular
+
+    # a packet made on a menu snapshot the bank has not seen means a crawl
+    # has changed the menu: the old pools are dropped and the most popular
+    # buckets are refilled in the background.
+    # fill = fill(bucket) -> (meals, days) for a bucket of this snapshot
+    def see_snapshot(self, snapshot, fill):
+        if not self.enabled():
+            return
+        with self.lock:
+            if snapshot == self.snapshot:
+                return
+            logging.info(f"( DayBank.see_snapshot ) new menu snapshot {snapshot}, dropping {len(self.banks)} buckets")
+            self.snapshot = snapshot
+            self.banks.clear()
+            self.pending.clear()
+            popular = self.most_popular()
+            self.decay()
+
+        for bucket in popular:
+            self.schedule_fill(snapshot, bucket, fill)
+
+    # days drawn from the pool of a bucket, or None when it is not banked.
+    # returns the MealPool the days point into and undated days
+    def draw(self, snapshot, bucket, days):
+        if not self.enabled():
+            return None
+        with self.lock:
+            self.requests[bucket] += 1
+            if len(self.requests) > self.max_buckets * 4:
+                self.decay()
+            bank = self.banks.get((snapshot, bucket))
+            if bank is None:
+                return None
+            self.banks.move_to_end((snapshot, bucket))
+
+        meals, bank_days = bank
+        if days <= len(bank_days):
+            return meals, random.sample(bank_days, days)
+        return meals, random.choices(bank_days, k=days)
+
+    # makes the pool of a bucket on the background thread, unless it is
+    # banked or already being made
+    def schedule_fill(self, snapshot, bucket, fill):
+        if not self.enabled():
+            return
+        with self.lock:
+            key = (snapshot, bucket)
+            if key in self.banks or key in self.pending:
+                return
+            self.pending.add(key)
+        self.filler.submit(self.run_fill, snapshot, bucket, fill)
+
+    def run_fill(self, snapshot, bucket, fill):
+        key = (snapshot, bucket)
+        try:
+            meals, bank_days = fill(bucket)
+        except Exception as e:
+            logging.error(f"( DayBank.run_fill ) error filling bucket {bucket}: {e}")
+            meals, bank_days = None, []
+
+        with self.lock:
+            if key not in self.pending:
+                # the snapshot changed while the pool was made
+                return
+            self.pending.discard(key)
+            if not bank_days:
+                return
+            self.banks[key] = (meals, bank_days)
+            while len(self.banks) > self.max_buckets:
+                self.banks.popitem(last=False)
+            logging.info(f"( DayBank.run_fill ) banked {len(bank_days)} days for bucket {bucket}, buckets: {len(self.banks)}")
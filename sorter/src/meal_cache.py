@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+# hash of the menu part of a packet, user parameters are left out
+# so every request made against the same menu gives the same key
+def menu_snapshot_key(item_dict):
+    menu = sorted(
+        (key, item.get('energyKcal'), item.get('foodType'))
+        for key, item in item_dict.items()
+        if isinstance(item, dict)
+    )
+    return hashlib.sha256(json.dumps(menu).encode('utf-8')).hexdigest() # menu_snapshot_key
+
+# the snapshotId codekcal put on the packet, or the menu hash of a packet
+# that carries the whole menu
+def packet_snapshot_key(packet):
+    return packet.get('snapshotId') or menu_snapshot_key(packet) # packet_snapshot_key
+
+# in process cache of meal pools keyed by (menu snapshot key, Mc_max)
+# least recently used pools are evicted when either max_entries or
+# max_bytes is passed, pools bigger than max_bytes are never stored
+class MealCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                logging.info(f"( MealCache.get ) miss - hits: {self.hits} misses: {self.misses}")
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            logging.info(f"( MealCache.get ) hit - hits: {self.hits} misses: {self.misses}")
+            return entry[0]
+
+    def put(self, key, meals):
+        size = meals.nbytes()
+        if self.max_entries <= 0 or size > self.max_bytes:
+            logging.info(f"( MealCache.put ) not caching {len(meals)} meals ({size} bytes)")
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (meals, size)
+            self.total_bytes += size
+
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+            logging.info(f"( MealCache.put ) entries: {len(self.entries)} bytes: {self.total_bytes}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+import requests
+import http_client
+
+# content hash of a menu, the same as codekcal gives its catalog snapshots
+def snapshot_id(menu):
+    return hashlib.sha256(json.dumps(menu, sort_keys=True).encode('utf-8')).hexdigest() # snapshot_id
+
+# menu snapshots published by codekcal, kept by snapshotId so packets only
+# have to carry the id. a snapshot that never reached the sorter (it was
+# published before the sorter started, or the packet overtook it) is
+# fetched from item_db through the gateway instead.
+# max_snapshots = snapshots kept, the oldest ones are dropped
+# catalog_url   = item_db codecal endpoint
+class SnapshotStore:
+    def __init__(self, max_snapshots, catalog_url):
+        self.max_snapshots = max_snapshots
+        self.catalog_url = catalog_url
+        self.snapshots = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, snapshot_id, menu):
+        with self.lock:
+            self.snapshots[snapshot_id] = menu
+            self.snapshots.move_to_end(snapshot_id)
+            while len(self.snapshots) > max(1, self.max_snapshots):
+                self.snapshots.popitem(last=False)
+        logging.info(f"( SnapshotStore.put ) snapshot {snapshot_id} of {len(menu)} items, snapshots: {len(self.snapshots)}")
+
+    # (snapshot id, menu) of a snapshot, None when it is neither kept nor
+    # fetchable. the id is the one of the menu returned, which is not
+    # wanted_id when item_db has moved on, see fetch
+    def get(self, wanted_id):
+        with self.lock:
+            menu = self.snapshots.get(wanted_id)
+        if menu is not None:
+            return wanted_id, menu
+        logging.info(f"( SnapshotStore.get ) snapshot {wanted_id} missing, fetching catalog")
+        return self.fetch(wanted_id)
+
+    # (snapshot id, menu) of the current catalog from item_db, used for the
+    # packet even when the catalog has moved on from the snapshot it was
+    # made on. the packet then has to carry the fetched id, so nothing made
+    # from the newer menu is cached under the old snapshot
+    def fetch(self, wanted_id):
+        try:
+            response = http_client.get(self.catalog_url)
+            response.raise_for_status()
+            menu = {
+                item['itemId']: {'energyKcal': item['energyKcal'], 'foodType': item['foodType']}
+                for item in response.json()
+            }
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            logging.error(f"( SnapshotStore.fetch ) An error occurred: {e}")
+            return None
+
+        fetched_id = snapshot_id(menu)
+        if fetched_id != wanted_id:
+            logging.warning(f"( SnapshotStore.fetch ) wanted snapshot {wanted_id}, item_db is at {fetched_id}")
+        self.put(fetched_id, menu)
+        return fetched_id, menu # fetch
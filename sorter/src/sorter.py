@@ -1,17 +1,27 @@
+import functools
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import signal
 import sys
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date, timedelta
 import requests
+import http_client
 from pika import exceptions
 import pika
 from dotenv import load_dotenv
-from itertools import combinations
+import math
 import random
+import numpy as np
+from meal_cache import MealCache, packet_snapshot_key
+from snapshot_store import SnapshotStore
+from day_bank import DayBank
 
 # global flag
 shutdown_flag = threading.Event()
@@ -26,16 +36,127 @@ logging.basicConfig(
     ]
 )
 
-# M  = min(1drink + >= 1food) where Mc <= (Di/Md)
-# Mc = caloric content of a meal
-# Di = calories +- range/2 = daily caloric intake
-# r  = range
-# c  = calories
-# md = meals per day
-# make groups of items that fit min(1 drink + >= 1 food)
-# where the caloric count of a group is <= (calories +- (range/2))/meals per day
-def make_meals(item_dict, r, c, md):
-    logging.info("( make_meals ) making meals ...")
+# largest drink x food combination block checked in one numpy operation
+MEAL_BATCH_CELLS = 1 << 20
+
+# deadline = time.time() a plan should be done by, None for no limit
+def past_deadline(deadline):
+    return deadline is not None and time.time() >= deadline
+
+# expands per group (start, count) pairs into one flat index array
+# starts = [2, 7], counts = [3, 1] -> [2, 3, 4, 7]
+def expand_ranges(starts, counts):
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    group_offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(total) - group_offsets
+    # expand_ranges
+
+# splits counts into consecutive slices whose counts add up to at most limit,
+# a single count over the limit gets a slice of its own
+def count_chunks(counts, limit):
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        base = ends[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(ends, base + limit, side='right')))
+        yield slice(start, stop)
+        start = stop
+    # count_chunks
+
+# kcal   = energyKcal of the candidate foods sorted ascending
+# bound  = largest food calorie sum that still fits next to the cheapest drink
+# yields blocks of rows of 1-3 positions into kcal whose sum is <= bound,
+# no block holds more than MEAL_BATCH_CELLS rows.
+# because kcal is sorted, every position past a searchsorted cut-off is
+# over the bound, so those combinations are never generated.
+def iter_food_combinations(kcal, bound):
+    n = len(kcal)
+    positions = np.arange(n)
+    yield positions.reshape(-1, 1)
+
+    # pairs: p < q with kcal[p] + kcal[q] <= bound
+    q_stop = np.searchsorted(kcal, bound - kcal, side='right')
+    q_count = np.clip(q_stop - (positions + 1), 0, None)
+    for pair_chunk in count_chunks(q_count, MEAL_BATCH_CELLS):
+        pair_p = np.repeat(positions[pair_chunk], q_count[pair_chunk])
+        pair_q = expand_ranges(positions[pair_chunk] + 1, q_count[pair_chunk])
+        yield np.stack([pair_p, pair_q], axis=1)
+
+        # triples: p < q < r with kcal[p] + kcal[q] + kcal[r] <= bound
+        r_stop = np.searchsorted(kcal, bound - kcal[pair_p] - kcal[pair_q], side='right')
+        r_count = np.clip(r_stop - (pair_q + 1), 0, None)
+        for triple_chunk in count_chunks(r_count, MEAL_BATCH_CELLS):
+            triple_r = expand_ranges(pair_q[triple_chunk] + 1, r_count[triple_chunk])
+            yield np.stack([
+                np.repeat(pair_p[triple_chunk], r_count[triple_chunk]),
+                np.repeat(pair_q[triple_chunk], r_count[triple_chunk]),
+                triple_r
+            ], axis=1)
+    # iter_food_combinations
+
+# meal indices sorted by totalCaloriesMeal, the meals within a calorie
+# range are found by binary search and returned as one slice
+class MealIndex:
+    def __init__(self, meal_calories):
+        self.order = np.argsort(meal_calories, kind='stable')
+        self.sorted_calories = meal_calories[self.order]
+
+    # meals with low <= totalCaloriesMeal <= high, in O(log n). the bounds are
+    # cast to the calorie dtype, searching an int32 array with a Python int
+    # would copy the whole array first
+    def between(self, low, high):
+        calorie_type = self.sorted_calories.dtype.type
+        start = self.sorted_calories.searchsorted(calorie_type(low), side='left')
+        stop = self.sorted_calories.searchsorted(calorie_type(high), side='right')
+        return self.order[start:stop]
+
+    # a random meal with low <= totalCaloriesMeal <= high, None if there is none
+    def draw(self, low, high):
+        candidates = self.between(low, high)
+        if len(candidates) == 0:
+            return None
+        return int(candidates[int(random.random() * len(candidates))])
+
+# meals stored as rows of indices into one item table instead of item dicts
+# items         = item dicts of the menu, each with its itemId
+# meal_items    = one row per meal: the drink index followed by up to three
+#                 food indices, -1 where a meal has fewer foods
+# meal_calories = totalCaloriesMeal of every row
+# complete      = False when the pool was cut short by a deadline
+class MealPool:
+    def __init__(self, items, meal_items, meal_calories, complete=True):
+        self.items = items
+        self.meal_items = meal_items
+        self.meal_calories = meal_calories
+        self.complete = complete
+        self.calorie_index = None
+
+    def __len__(self):
+        return len(self.meal_calories)
+
+    def nbytes(self):
+        return self.meal_items.nbytes + self.meal_calories.nbytes
+
+    # MealIndex of the pool, made on first use and kept with the pool
+    def index(self):
+        if self.calorie_index is None:
+            self.calorie_index = MealIndex(self.meal_calories)
+        return self.calorie_index
+
+    # a meal as the dict stored in menu_plan_db
+    def meal(self, index):
+        return {
+            'items': [self.items[item] for item in self.meal_items[index].tolist() if item >= 0],
+            'totalCaloriesMeal': int(self.meal_calories[index])
+        }
+
+def empty_meal_pool(items=None):
+    return MealPool(items or [], np.empty((0, 4), dtype=np.int32), np.empty(0, dtype=np.int32))
+
+# the drinks and foods of a packet, each with its itemId
+def split_menu(item_dict):
     drinks = [
         {**item, 'itemId': key}
         for key, item in item_dict.items()
@@ -46,94 +167,343 @@ def make_meals(item_dict, r, c, md):
         for key, item in item_dict.items()
         if isinstance(item, dict) and item.get('foodType') == 'food'
     ]
-    meals = []
+    return drinks, foods # split_menu
+
+# drops every drink over Mc_max and every food that cannot fit next to the
+# cheapest remaining drink. returns the drinks, the calories of all foods,
+# the indices of the remaining foods sorted by energyKcal and the food bound
+def prune_menu(drinks, foods, Mc_max):
+    drinks = [drink for drink in drinks if drink['energyKcal'] <= Mc_max]
+    food_kcal = np.array([food['energyKcal'] for food in foods], dtype=np.float64)
+    if not drinks:
+        return drinks, food_kcal, np.empty(0, dtype=np.int64), 0
+
+    # int(total) <= Mc_max holds exactly when total < floor(Mc_max) + 1
+    food_bound = math.floor(Mc_max) + 1 - min(drink['energyKcal'] for drink in drinks)
+
+    candidates = np.flatnonzero(food_kcal < food_bound)
+    candidates = candidates[np.argsort(food_kcal[candidates], kind='stable')]
+    return drinks, food_kcal, candidates, food_bound # prune_menu
+
+# combo         = rows of food indices
+# returns the rows as item table rows, foods sit after the drinks in the
+# table, and their calories summed in the same order as sum() over the row
+def food_rows(combo, food_kcal, drink_count):
+    calories = np.zeros(len(combo))
+    for column in combo.T:
+        calories = calories + food_kcal[column]
+
+    rows = np.full((len(combo), 3), -1, dtype=np.int32)
+    rows[:, :combo.shape[1]] = combo + drink_count
+    return rows, calories # food_rows
+
+# pairs every drink with every food row, in drink then food row order.
+# yields meal rows and meal calories of the pairs within Mc_max, the
+# drinks are checked in blocks of at most MEAL_BATCH_CELLS pairs
+def pair_with_drinks(drinks, rows, calories, Mc_max):
+    batch_size = max(1, MEAL_BATCH_CELLS // max(1, len(calories)))
+    for batch_start in range(0, len(drinks), batch_size):
+        drink_kcal = np.array(
+            [drink['energyKcal'] for drink in drinks[batch_start:batch_start + batch_size]],
+            dtype=np.float64
+        )
+        total_calories = np.trunc(drink_kcal[:, None] + calories[None, :])
+        drink_index, combo_index = np.nonzero(total_calories <= Mc_max)
+
+        meal_items = np.empty((len(drink_index), 4), dtype=np.int32)
+        meal_items[:, 0] = drink_index + batch_start
+        meal_items[:, 1:] = rows[combo_index]
+        yield meal_items, total_calories[drink_index, combo_index].astype(np.int32)
+    # pair_with_drinks
+
+# M  = min(1drink + >= 1food) where Mc <= (Di/Md)
+# Mc = caloric content of a meal
+# Di = calories +- range/2 = daily caloric intake
+# r  = range
+# c  = calories
+# md = meals per day
+# make groups of items that fit min(1 drink + >= 1 food)
+# where the caloric count of a group is <= (calories +- (range/2))/meals per day
+#
+# foods are sorted by energyKcal and anything that cannot fit next to the
+# cheapest drink is dropped before combinations are built. the combinations
+# are then put back in itertools.combinations order, so the pool holds the
+# same meals in the same order the plain drink x combination loop would.
+# past the deadline no more combinations or meals are made, and the meals
+# made so far are returned marked incomplete.
+def make_meals(item_dict, r, c, md, deadline=None):
+    logging.info("( make_meals ) making meals ...")
+    drinks, foods = split_menu(item_dict)
 
     if not drinks:
         logging.error("No drinks available.")
-        return []
+        return empty_meal_pool()
     if not foods:
         logging.error("No foods available.")
-        return []
+        return empty_meal_pool()
 
     Di_max = c + (r / 2)
     Mc_max = Di_max / md
 
-    food_combinations = []
-    for i in range(1, min(4, len(foods) + 1)):
-        food_combinations.extend(combinations(foods, i))
-
-    # Generate meals by pairing each drink with food combinations
-    for drink in drinks:
-        drink_calories = drink['energyKcal']
-        if drink_calories > Mc_max:
-            continue
-        for food_combo in food_combinations:
-            food_calories = sum(item['energyKcal'] for item in food_combo)
-            total_calories = drink_calories + food_calories
-            total_calories = int(total_calories)
-            if total_calories <= Mc_max:
-                meal_items = [drink] + list(food_combo)
-                meals.append({
-                    'items': meal_items,
-                    'totalCaloriesMeal': total_calories
-                })
-
-    return meals  # make_meals
-
-
-# meals         = list of meals from make_meals
-# days          = number of days diet plan spans
+    drinks, food_kcal, candidates, food_bound = prune_menu(drinks, foods, Mc_max)
+    if not drinks or len(candidates) == 0:
+        return empty_meal_pool()
+
+    # back to item order, one block per combination size like combinations() yields
+    complete = True
+    combos_by_size = {1: [], 2: [], 3: []}
+    for combo in iter_food_combinations(food_kcal[candidates], food_bound):
+        if past_deadline(deadline):
+            complete = False
+            break
+        combos_by_size[combo.shape[1]].append(np.sort(candidates[combo], axis=1))
+
+    rows = []
+    calories = []
+    for size, combos in combos_by_size.items():
+        combo = np.concatenate(combos) if combos else np.empty((0, size), dtype=np.int64)
+        combo = combo[np.lexsort(combo.T[::-1])]
+        size_rows, size_calories = food_rows(combo, food_kcal, len(drinks))
+        rows.append(size_rows)
+        calories.append(size_calories)
+
+    # Generate meals by pairing each drink with food combinations, a pool
+    # cut short keeps at least its first block of meals
+    batches = [(np.empty((0, 4), dtype=np.int32), np.empty(0, dtype=np.int32))]
+    for batch in pair_with_drinks(drinks, np.concatenate(rows), np.concatenate(calories), Mc_max):
+        batches.append(batch)
+        if past_deadline(deadline):
+            complete = False
+            break
+    if not complete:
+        logging.warning("( make_meals ) deadline passed, returning the meals made so far")
+    return MealPool(
+        drinks + foods,
+        np.concatenate([meal_items for meal_items, _ in batches]),
+        np.concatenate([meal_calories for _, meal_calories in batches]),
+        complete
+    )  # make_meals
+
+# food rows and their calories in blocks as they are generated, in no
+# particular order. nothing is kept between blocks
+def iter_food_blocks(drink_count, food_kcal, candidates, food_bound):
+    if drink_count == 0 or len(candidates) == 0:
+        return
+    for combo in iter_food_combinations(food_kcal[candidates], food_bound):
+        yield food_rows(np.sort(candidates[combo], axis=1), food_kcal, drink_count)
+    # iter_food_blocks
+
+# sample_size meals drawn uniformly from every meal make_meals would return,
+# without ever holding more than the sample and one block in memory.
+# weighted reservoir sampling over food combinations: a combination weighs
+# as many meals as there are drinks that fit next to it, so meals are never
+# built for the whole pool. each slot of the sample is taken over by a
+# block with the block's share of all weight seen so far, which leaves every
+# slot holding a uniform draw from the pool. while the pool is no bigger
+# than the sample its meals are kept as they are, and returned whole.
+# past the deadline no more blocks are read, and what was kept of the
+# blocks seen so far is returned marked incomplete.
+def sample_meals(item_dict, r, c, md, sample_size, deadline=None):
+    logging.info(f"( sample_meals ) sampling {sample_size} meals ...")
+    drinks, foods = split_menu(item_dict)
+    Mc_max = (c + (r / 2)) / md
+    drinks, food_kcal, candidates, food_bound = prune_menu(drinks, foods, Mc_max)
+    items = drinks + foods
+
+    # int(drink + food) <= Mc_max holds exactly when drink < floor(Mc_max) + 1 - food
+    kcal_limit = math.floor(Mc_max) + 1
+    drink_kcal = np.array([drink['energyKcal'] for drink in drinks], dtype=np.float64)
+    drink_order = np.argsort(drink_kcal, kind='stable')
+    sorted_drink_kcal = drink_kcal[drink_order]
+
+    rng = np.random.default_rng(random.getrandbits(64))
+    sample = MealPool(items, np.empty((sample_size, 4), dtype=np.int32), np.empty(sample_size, dtype=np.int32))
+    # every meal seen, until there are more than the sample holds
+    batches = []
+    weight_seen = 0
+    complete = True
+    for rows, calories in iter_food_blocks(len(drinks), food_kcal, candidates, food_bound):
+        drink_counts = np.searchsorted(sorted_drink_kcal, kcal_limit - calories, side='left')
+        block_weight = int(drink_counts.sum())
+        if block_weight > 0:
+            weight_seen += block_weight
+            if batches is not None:
+                if weight_seen <= sample_size:
+                    batches.extend(pair_with_drinks(drinks, rows, calories, Mc_max))
+                else:
+                    batches = None
+
+            # the first block fills every slot
+            slots = np.flatnonzero(rng.random(sample_size) < block_weight / weight_seen)
+            combo = np.searchsorted(np.cumsum(drink_counts), rng.random(len(slots)) * block_weight, side='right')
+            drink = drink_order[(rng.random(len(slots)) * drink_counts[combo]).astype(np.int64)]
+
+            sample.meal_items[slots, 0] = drink
+            sample.meal_items[slots, 1:] = rows[combo]
+            sample.meal_calories[slots] = np.trunc(drink_kcal[drink] + calories[combo])
+
+        if past_deadline(deadline):
+            logging.warning(f"( sample_meals ) deadline passed, sampled {weight_seen} meals")
+            complete = False
+            break
+
+    if weight_seen == 0:
+        return empty_meal_pool(items)
+    if batches is not None:
+        logging.info(f"( sample_meals ) kept all {weight_seen} meals")
+        sample = MealPool(
+            items,
+            np.concatenate([meal_items for meal_items, _ in batches]),
+            np.concatenate([meal_calories for _, meal_calories in batches])
+        )
+    else:
+        logging.info(f"( sample_meals ) kept {sample_size} of {weight_seen} meals")
+    sample.complete = complete
+    return sample # sample_meals
+
+
+# make_meals through the meal cache, a meal pool only depends on the
+# menu and Mc_max so requests with the same per meal cap share it.
+# sample_size = when above 0, a streamed sample of at most this many
+#               meals is made instead of the full pool
+# deadline    = see sample_meals and make_meals, pools cut short are not cached
+def get_meals(item_dict, r, c, md, meal_cache, sample_size, deadline=None):
+    Mc_max = (c + (r / 2)) / md
+    key = (packet_snapshot_key(item_dict), Mc_max)
+
+    meals = meal_cache.get(key)
+    if meals is None:
+        if sample_size > 0:
+            meals = sample_meals(item_dict, r, c, md, sample_size, deadline)
+        else:
+            meals = make_meals(item_dict, r, c, md, deadline)
+        if meals.complete:
+            meal_cache.put(key, meals)
+    return meals # get_meals
+
+# draws an index from a table of non-negative weights
+def weighted_index(weights):
+    cumulative = np.cumsum(weights)
+    return int(np.searchsorted(cumulative, random.random() * cumulative[-1], side='right'))
+    # weighted_index
+
+# calorie_counts = calorie_counts[v] is the number of meals with v calories
+# meals_per_day  = number of meals in a day
+# low, high      = whole calorie bounds of a day
+# completions[k][s] is the number of ways k more meals take a day that
+# already holds s calories to a total within [low, high]. completions[0]
+# is the window itself and every step adds one meal to it.
+def make_completion_table(calorie_counts, meals_per_day, low, high):
+    completions = [np.zeros(high + 1)]
+    completions[0][low:] = 1
+    for _ in range(meals_per_day):
+        # completions[k][s] = sum over v of calorie_counts[v] * completions[k - 1][s + v]
+        step = np.convolve(completions[-1], calorie_counts[::-1])
+        completions.append(step[high:])
+    return completions # make_completion_table
+
+# meals         = MealPool from make_meals
 # meals_per_day = number of meals in a day
 # Di_min        = minimum of daily caloric intake = calories - (range / 2)
 # Di_max        = maximum of daily caloric intake = calories + (range / 2)
-# combine meals into days of eating, where the number of meals in a
+# first_day     = days from today of the first day yielded
+# deadline      = no more days are yielded once it has passed, the
+#                 first day is always made
+# yields days of eating one after another, where the number of meals in a
 # day of eating = meals_per_day, and a day of eating
 # should have a caloric count within the range of Di_min and Di_max.
-def make_days(meals, days, meals_per_day, Di_min, Di_max):
-    logging.info("( make_days ) making days ...")
-    days_list = []
-    while len(days_list) < days:
+#
+# instead of drawing random days until one lands in the window, every meal
+# is drawn from the calorie values that can still complete the day, weighted
+# by how many completions each value leaves. every draw ends in a valid day,
+# and days are as likely as under the old draw-and-reject loop. when no day
+# can reach the window the plan is reported infeasible right away.
+# meals are looked up in the MealIndex of the pool, the last meal of a day
+# is drawn straight from the meals that fit the calories left.
+def iter_days(meals, meals_per_day, Di_min, Di_max, first_day=0, deadline=None):
+    low = max(0, math.ceil(Di_min))
+    high = math.floor(Di_max)
+    if not meals or high < low:
+        logging.error(f"( iter_days ) infeasible: no meals or empty calorie window [ {Di_min}, {Di_max} ]")
+        return
+
+    meal_calories = meals.meal_calories
+    meal_index = meals.index()
+    calorie_counts = np.bincount(meal_calories[meal_calories <= high], minlength=high + 1).astype(np.float64)
+    completions = make_completion_table(calorie_counts, meals_per_day, low, high)
+
+    if completions[meals_per_day][0] == 0:
+        logging.error(f"( iter_days ) infeasible: no {meals_per_day} meals add up to between {Di_min} and {Di_max} kcal")
+        return
+
+    day_number = first_day
+    while True:
+        if day_number > first_day and past_deadline(deadline):
+            logging.warning(f"( iter_days ) deadline passed after {day_number - first_day} days")
+            return
+
         temp_day = {}
         day_meals = []
         total_calories = 0
-        i = 0
-
-        while i <= meals_per_day:
-            meal = random.choice(meals)
-            day_meals.append(meal)
-            total_calories += int(meal['totalCaloriesMeal'])
-            i += 1
 
-        if Di_min <= total_calories <= Di_max:
-            current_date = date.today() + timedelta(days=len(days_list))
-            temp_day['date'] = current_date.strftime('%m/%d/%Y')
-            temp_day['meals'] = day_meals
-            temp_day['totalCaloriesDay'] = total_calories
-            days_list.append(temp_day)
+        for meals_left in range(meals_per_day, 1, -1):
+            weights = calorie_counts[:high + 1 - total_calories] * completions[meals_left - 1][total_calories:]
+            calories = weighted_index(weights)
+            day_meals.append(meal_index.draw(calories, calories))
+            total_calories += calories
+
+        # every meal within the calories left completes the day equally
+        last_meal = meal_index.draw(low - total_calories, high - total_calories)
+        day_meals.append(last_meal)
+        total_calories += int(meal_calories[last_meal])
+
+        current_date = date.today() + timedelta(days=day_number)
+        temp_day['date'] = current_date.strftime('%m/%d/%Y')
+        temp_day['meals'] = day_meals
+        temp_day['totalCaloriesDay'] = total_calories
+        yield temp_day
+        day_number += 1
+    # iter_days
+
+# days = number of days diet plan spans
+# combine meals into days of eating, see iter_days
+def make_days(meals, days, meals_per_day, Di_min, Di_max, deadline=None):
+    logging.info("( make_days ) making days ...")
+    return list(itertools.islice(iter_days(meals, meals_per_day, Di_min, Di_max, deadline=deadline), days))  # make_days
 
-    return days_list  # make_days
 
+# the meal indices of every day turned back into item dicts
+def expand_days(calendar_days, meals):
+    return [
+        {**day, 'meals': [meals.meal(index) for index in day['meals']]}
+        for day in calendar_days
+    ] # expand_days
 
-# append menu plan to packet
-def append_plan_to_packet(user, calories, range, days, meals_per_day, calendar_days):
+# append menu plan to packet, the meal indices of every day
+# are turned back into item dicts here
+# complete = False when the plan was cut short by its deadline
+def append_plan_to_packet(user, calories, range, days, meals_per_day, calendar_days, meals, complete=True):
     logging.info("( append_plan_to_packet ) appending menu plan to packet ...")
     db_packet = {'user': user,
                  'calories': calories,
                  'range': range,
                  'days': days,
                  'mealsPerDay': meals_per_day,
-                 'plan': calendar_days}
+                 'complete': complete,
+                 'plan': expand_days(calendar_days, meals)}
     return db_packet # append_plan_to_packet
 
+# stores a plan, returns the stored plan or None when it failed
 def send_to_db(packet, api_url):
     if packet:
-        logging.info(f"Sending packet on url: {api_url} {json.dumps(packet, indent=4)}")
+        logging.info(f"Sending packet on url: {api_url} user: [ {packet['user']} ] days: [ {len(packet['plan'])} ]")
         try:
-            response = requests.post(api_url, json=packet)
+            response = http_client.post(api_url, json=packet)
 
             if response.status_code == 200:
                 logging.info("Successfully sent data to the API.")
                 logging.info(f"Status code: {response.status_code}")
+                return response.json()
             else:
                 logging.error(f"Failed to send data. Status code: {response.status_code}")
                 logging.error(f"Response: {response.text}")
@@ -142,49 +512,321 @@ def send_to_db(packet, api_url):
             logging.error(f"An error occurred: {e}")
     else:
         logging.info("empty json")
+    return None
     # send_data
 
+# appends days to a plan already stored in menu_plan_db,
+# complete=False marks the stored plan incomplete
+def append_days_to_db(calendar_days, api_url, plan_id, complete=True):
+    append_url = f"{api_url}/{plan_id}/days"
+    params = {'complete': 'true' if complete else 'false'}
+    logging.info(f"( append_days_to_db ) appending {len(calendar_days)} days on url: {append_url}")
+    try:
+        response = http_client.post(append_url, json=calendar_days, params=params)
+        if response.status_code == 200:
+            return True
+        logging.error(f"( append_days_to_db ) Failed to append days. Status code: {response.status_code}")
+        logging.error(f"( append_days_to_db ) Response: {response.text}")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"( append_days_to_db ) An error occurred: {e}")
+    return False
+    # append_days_to_db
+
+# stores the plan chunk_days days at a time: the first chunk creates the
+# plan and every later chunk is appended as soon as it is made, so the
+# first days are in menu_plan_db before the last ones are drawn.
+# the plan is stored incomplete and only marked complete by its last chunk,
+# so a plan whose appends fail or are cut short by the deadline stays
+# marked incomplete.
+# returns False when the plan could not be created
+def send_plan_in_chunks(user, calories, range, days, meals_per_day, meals, Di_min, Di_max, api_url, chunk_days,
+                        deadline=None):
+    day_source = iter_days(meals, meals_per_day, Di_min, Di_max, deadline=deadline)
+
+    first_size = min(days, chunk_days)
+    first_chunk = list(itertools.islice(day_source, first_size))
+    if not first_chunk:
+        logging.error(f"( send_plan_in_chunks ) no plan could be made for user: [ {user} ], meal pool complete: {meals.complete}")
+        # only a full pool shows the request can not be met
+        return meals.complete
+
+    days_complete = len(first_chunk) == first_size
+    db_packet = append_plan_to_packet(
+        user, calories, range, days, meals_per_day, first_chunk, meals,
+        meals.complete and days_complete and first_size == days
+    )
+    stored_plan = send_to_db(db_packet, api_url)
+    if not stored_plan:
+        return False
+
+    days_sent = len(first_chunk)
+    while days_complete and days_sent < days:
+        chunk_size = min(days - days_sent, chunk_days)
+        chunk = list(itertools.islice(day_source, chunk_size))
+        days_complete = len(chunk) == chunk_size
+        complete = meals.complete and days_complete and days_sent + len(chunk) == days
+        # a partly stored plan is kept rather than stored twice on a retry
+        if not append_days_to_db(expand_days(chunk, meals), api_url, stored_plan['id'], complete):
+            logging.error(f"( send_plan_in_chunks ) could not append days for user: [ {user} ]")
+            break
+        days_sent += len(chunk)
+
+    if days_sent < days:
+        logging.warning(f"( send_plan_in_chunks ) plan for user: [ {user} ] stored with {days_sent} of {days} days")
+
+    return True # send_plan_in_chunks
+
+# the banked days of a bucket, made on the background thread of the day bank
+# bucket = (calories, range, mealsPerDay)
+def fill_day_bank(item_dict, bucket, meal_cache, settings):
+    calories, range, meals_per_day = bucket
+    Di_max = calories + (range / 2)
+    Di_min = calories - (range / 2)
+    meals = get_meals(item_dict, range, calories, meals_per_day, meal_cache, settings['sample_size'])
+    bank_days = make_days(meals, settings['day_bank_days'], meals_per_day, Di_min, Di_max)
+    return meals, bank_days # fill_day_bank
+
+# days drawn from the day bank get the dates of the plan they are put in
+def date_days(bank_days):
+    return [
+        {**day, 'date': (date.today() + timedelta(days=day_number)).strftime('%m/%d/%Y')}
+        for day_number, day in enumerate(bank_days)
+    ] # date_days
+
 def graceful_shutdown(signal, frame):
     shutdown_flag.set()
     logging.info(f"Signal {signal} received. Shutting down.")
 
-def on_message(ch, method, properties, body, api_url):
-    items = body.decode('utf-8')
-    string_to_list = json.loads(items)
-
-    calories = string_to_list.get('calories')
-    range = string_to_list.get('range')
+# the packet of a message with the menu of its snapshot merged in, packets
+# without a snapshotId carry the whole menu already.
+# None when the message can not be read or its snapshot can not be found
+def resolve_packet(body, snapshot_store):
+    try:
+        packet = json.loads(body.decode('utf-8'))
+    except ValueError as e:
+        logging.error(f"( resolve_packet ) bad packet: {e}")
+        return None
+
+    snapshot_id = packet.get('snapshotId')
+    if snapshot_id is None:
+        return packet
+    snapshot = snapshot_store.get(snapshot_id)
+    if snapshot is None:
+        logging.error(f"( resolve_packet ) no menu for snapshot {snapshot_id}")
+        return None
+    # the id of the menu actually used, meal pools and banked days are kept by it
+    resolved_id, menu = snapshot
+    return {**menu, **packet, 'snapshotId': resolved_id} # resolve_packet
+
+# makes a plan from a packet and stores it in menu_plan_db
+# returns False when the plan could not be stored and the message
+# should be retried, a request no plan can be made for is done
+# settings = sample_size:   meals sampled per pool, 0 makes every meal
+#            chunk_days:    days stored per request, 0 stores the plan at once
+#            day_bank_days: days banked per bucket, see DayBank
+#            time_budget:   seconds a message may take, see message_deadline
+# deadline = time.time() the plan should be stored by, when it passes the
+#            days made so far are stored as an incomplete plan
+def make_plan(packet, api_url, meal_cache, day_bank, settings, deadline=None):
+    calories = packet.get('calories')
+    range = packet.get('range')
     Di_max = calories + (range / 2)
     Di_min = calories - (range / 2)
-    days = string_to_list.get('days')
-    user = string_to_list.get('user')
+    days = packet.get('days')
+    user = packet.get('user')
 
-    meals_per_day = string_to_list.get('mealsPerDay')
+    meals_per_day = packet.get('mealsPerDay')
 
     logging.info(f"user: [ {user} ] calories: [ {calories} ] range: [ {range} ] days: [ {days} ] meals_per_day: [ {meals_per_day} ]")
     logging.info(f"user: [ {type(user)} ] calories: [ {type(calories)} ] range: [ {type(range)} ] days: [ {type(days)} ] meals_per_day: [ {type(meals_per_day)} ]")
 
-    meals = make_meals(string_to_list, range, calories, meals_per_day)
+    # popular buckets are drawn from the day bank
+    snapshot = packet_snapshot_key(packet)
+    bucket = (calories, range, meals_per_day)
+    fill = functools.partial(fill_day_bank, packet, meal_cache=meal_cache, settings=settings)
+    day_bank.see_snapshot(snapshot, fill)
+    banked = day_bank.draw(snapshot, bucket, days)
+    if banked:
+        meals, bank_days = banked
+        logging.info(f"( make_plan ) {days} days drawn from the day bank for user: [ {user} ]")
+        db_packet = append_plan_to_packet(user, calories, range, days, meals_per_day, date_days(bank_days), meals)
+        return send_to_db(db_packet, api_url) is not None
+    # a bucket is only banked once it is among the most requested, so one
+    # off requests do not start a fill of day_bank_days days each
+    if day_bank.popular(bucket):
+        day_bank.schedule_fill(snapshot, bucket, fill)
+
+    # half of what is left of the budget goes to the meal pool, so a pool
+    # cut short still leaves time to make days from it
+    meals_deadline = None if deadline is None else time.time() + (deadline - time.time()) / 2
+    meals = get_meals(packet, range, calories, meals_per_day, meal_cache, settings['sample_size'], meals_deadline)
+
+    chunk_days = settings['chunk_days']
+    if 0 < chunk_days < days:
+        return send_plan_in_chunks(
+            user, calories, range, days, meals_per_day, meals, Di_min, Di_max, api_url, chunk_days, deadline
+        )
 
-    calendar_days = make_days(meals, days, meals_per_day, Di_min, Di_max)
+    calendar_days = make_days(meals, days, meals_per_day, Di_min, Di_max, deadline)
+    if not calendar_days:
+        logging.error(f"( make_plan ) no plan could be made for user: [ {user} ], meal pool complete: {meals.complete}")
+        # only a full pool shows the request can not be met
+        return meals.complete
+
+    complete = meals.complete and len(calendar_days) == days
+    if not complete:
+        logging.warning(f"( make_plan ) deadline passed, storing {len(calendar_days)} of {days} days for user: [ {user} ]")
+    db_packet = append_plan_to_packet(user, calories, range, days, meals_per_day, calendar_days, meals, complete)
+    return send_to_db(db_packet, api_url) is not None
+    # make_plan
+
+# meal cache and day bank of a worker process, every worker keeps its own
+worker_meal_cache = None
+worker_day_bank = None
+worker_settings = None
+
+def make_day_bank(settings):
+    return DayBank(settings['day_bank_days'], settings['day_bank_buckets'], settings['day_bank_popular'], settings['day_bank_min_requests'])
+
+def init_worker(max_entries, max_bytes, settings):
+    global worker_meal_cache, worker_day_bank, worker_settings
+    worker_meal_cache = MealCache(max_entries, max_bytes)
+    worker_day_bank = make_day_bank(settings)
+    worker_settings = settings
+    # shutdown is handled by the consumer process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def make_plan_in_worker(packet, api_url, deadline):
+    return make_plan(packet, api_url, worker_meal_cache, worker_day_bank, worker_settings, deadline)
+
+# the plan worker processes. a worker that dies (killed for memory on a
+# large menu) breaks the whole pool, so a new pool is started and the
+# message is handed to it. only when the new pool is broken as well is the
+# message nacked
+# meal_cache.max_bytes is the budget of all workers together, every worker
+# gets an equal share of it for its own cache
+class PlanWorkers:
+    def __init__(self, worker_count, meal_cache, settings):
+        self.worker_count = worker_count
+        self.initargs = (meal_cache.max_entries, meal_cache.max_bytes // worker_count, settings)
+        self.pool = self.start()
+
+    def start(self):
+        return ProcessPoolExecutor(
+            max_workers=self.worker_count,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=self.initargs
+        )
 
-    db_packet = append_plan_to_packet(user, calories, range, days, meals_per_day, calendar_days)
-    send_to_db(db_packet, api_url)
+    def submit(self, fn, *args):
+        try:
+            return self.pool.submit(fn, *args)
+        except BrokenProcessPool:
+            logging.error("( PlanWorkers.submit ) a plan worker died, starting new workers")
+            self.pool.shutdown(wait=False)
+            self.pool = self.start()
+            return self.pool.submit(fn, *args)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+# the time.time() a message should be done by, counted from when it is
+# received. the x-time-budget-s header overrides the time_budget setting,
+# a budget of 0 means no limit
+def message_deadline(properties, settings):
+    headers = properties.headers or {}
+    try:
+        budget = float(headers.get('x-time-budget-s', settings['time_budget']))
+    except (TypeError, ValueError):
+        logging.error(f"( message_deadline ) bad x-time-budget-s header: {headers.get('x-time-budget-s')}")
+        budget = settings['time_budget']
+    if budget <= 0:
+        return None
+    return time.time() + budget # message_deadline
+
+# acks a message once its plan is stored, a failed message is
+# requeued once and dropped if it fails again
+def finish_message(ch, delivery_tag, redelivered, stored):
+    if stored:
+        ch.basic_ack(delivery_tag=delivery_tag)
+    else:
+        logging.error(f"( finish_message ) plan not stored, requeue: {not redelivered}")
+        ch.basic_nack(delivery_tag=delivery_tag, requeue=not redelivered)
+
+def on_message(ch, method, properties, packet, api_url, meal_cache, day_bank, settings):
+    try:
+        stored = make_plan(packet, api_url, meal_cache, day_bank, settings, message_deadline(properties, settings))
+    except Exception as e:
+        logging.error(f"( on_message ) error making plan: {e}")
+        stored = False
+    finish_message(ch, method.delivery_tag, method.redelivered, stored)
     # on_message
 
-def create_on_message_callback(api_url):
+# hands the message to the worker pool, the ack is sent from the
+# connection thread when the worker is done
+def on_message_to_pool(ch, method, properties, packet, api_url, settings, connection, pool):
+    def on_done(future):
+        try:
+            stored = future.result()
+        except Exception as e:
+            logging.error(f"( on_message_to_pool ) error making plan: {e}")
+            stored = False
+        try:
+            connection.add_callback_threadsafe(
+                functools.partial(finish_message, ch, method.delivery_tag, method.redelivered, stored)
+            )
+        except Exception as e:
+            logging.error(f"( on_message_to_pool ) could not finish message: {e}")
+
+    deadline = message_deadline(properties, settings)
+    try:
+        future = pool.submit(make_plan_in_worker, packet, api_url, deadline)
+    except Exception as e:
+        # runs on the connection thread, which must outlive a broken pool
+        logging.error(f"( on_message_to_pool ) could not hand plan to a worker: {e}")
+        finish_message(ch, method.delivery_tag, method.redelivered, False)
+        return
+    future.add_done_callback(on_done)
+    # on_message_to_pool
+
+def create_on_message_callback(api_url, meal_cache, day_bank, snapshot_store, settings, connection, pool):
     logging.info(f"( create_on_message_callback ) create_on_message_callback")
     def on_message_callback(ch, method, properties, body):
         logging.info(f"( on_message_callback ) on_message_callback")
-        on_message(ch, method, properties, body, api_url)
+        packet = resolve_packet(body, snapshot_store)
+        if packet is None:
+            finish_message(ch, method.delivery_tag, method.redelivered, False)
+        elif pool:
+            on_message_to_pool(ch, method, properties, packet, api_url, settings, connection, pool)
+        else:
+            on_message(ch, method, properties, packet, api_url, meal_cache, day_bank, settings)
     return on_message_callback
 
-def run_consumer(queue_name, api_url, rabbitmq_user, rabbitmq_password, rabbitmq_host):
+# keeps the menu snapshots codekcal publishes
+def create_on_snapshot_callback(snapshot_store):
+    def on_snapshot_callback(ch, method, properties, body):
+        try:
+            snapshot = json.loads(body.decode('utf-8'))
+            snapshot_store.put(snapshot['snapshotId'], snapshot['menu'])
+        except (ValueError, KeyError) as e:
+            logging.error(f"( on_snapshot_callback ) bad snapshot: {e}")
+    return on_snapshot_callback
+
+# worker_count = plan worker processes, 0 makes plans on the consumer thread
+# snapshot_exchange_name = exchange codekcal publishes menu snapshots on
+def run_consumer(queue_name, api_url, meal_cache, day_bank, snapshot_store, snapshot_exchange_name, settings, worker_count, rabbitmq_user, rabbitmq_password, rabbitmq_host):
     if not queue_name:
         logging.error("One or more required environment variables are missing. Exiting.")
         sys.exit(1)
 
+    pool = None
     try:
+        if worker_count > 0:
+            logging.info(f"( run_consumer ) starting {worker_count} plan workers")
+            pool = PlanWorkers(worker_count, meal_cache, settings)
+
         # Establish connection
         credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_password)
         connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host, credentials=credentials))
@@ -193,13 +835,27 @@ def run_consumer(queue_name, api_url, rabbitmq_user, rabbitmq_password, rabbitmq
         # Declare the parameter queue
         channel.queue_declare(queue=queue_name, durable=True)
 
+        # one unacked message per worker
+        channel.basic_qos(prefetch_count=max(1, worker_count))
+
         # Define the callback with additional arguments
         channel.basic_consume(
             queue=queue_name,
-            on_message_callback=create_on_message_callback(api_url),
-            auto_ack=True
+            on_message_callback=create_on_message_callback(api_url, meal_cache, day_bank, snapshot_store, settings, connection, pool),
+            auto_ack=False
         )
 
+        # own queue on the snapshot exchange, dropped when the sorter stops
+        if snapshot_exchange_name:
+            channel.exchange_declare(exchange=snapshot_exchange_name, exchange_type='fanout', durable=True)
+            snapshot_queue = channel.queue_declare(queue='', exclusive=True).method.queue
+            channel.queue_bind(exchange=snapshot_exchange_name, queue=snapshot_queue)
+            channel.basic_consume(
+                queue=snapshot_queue,
+                on_message_callback=create_on_snapshot_callback(snapshot_store),
+                auto_ack=True
+            )
+
         logging.info(f"waiting for message from {queue_name}")
 
         # Start consuming in a separate thread to allow graceful shutdown
@@ -217,6 +873,9 @@ def run_consumer(queue_name, api_url, rabbitmq_user, rabbitmq_password, rabbitmq
         logging.error(f"AMQP connection error: {e}")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
+    finally:
+        if pool:
+            pool.shutdown(wait=True)
     # run_consumer
 
 def run():
@@ -237,7 +896,7 @@ def run():
     api_url = f"http://{menu_db_host_name}:{db_port}/api/plan"
 
     if test_flag:
-        response = requests.get(api_url)
+        response = http_client.get(api_url)
         logging.info(f"API response: {response.text}")
         logging.info(f"response code: {response.status_code}")
 
@@ -249,13 +908,50 @@ def run():
     rabbitmq_password = os.getenv('RABBITMQ_PASS')
     rabbitmq_host = os.getenv('RABBITMQ_HOST')
 
+    # meal pools shared between requests on the same menu
+    meal_cache = MealCache(
+        max_entries=int(os.getenv('MEAL_CACHE_MAX_ENTRIES', 16)),
+        max_bytes=int(os.getenv('MEAL_CACHE_MAX_MB', 512)) * 1024 * 1024
+    )
+
+    # plan settings, see make_plan
+    settings = {
+        'sample_size': int(os.getenv('MEAL_SAMPLE_SIZE', 200000)),
+        'chunk_days': int(os.getenv('PLAN_CHUNK_DAYS', 7)),
+        'day_bank_days': int(os.getenv('DAY_BANK_DAYS', 365)),
+        'day_bank_buckets': int(os.getenv('DAY_BANK_BUCKETS', 32)),
+        'day_bank_popular': int(os.getenv('DAY_BANK_POPULAR', 8)),
+        'day_bank_min_requests': int(os.getenv('DAY_BANK_MIN_REQUESTS', 3)),
+        'time_budget': float(os.getenv('PLAN_TIME_BUDGET_S', 0))
+    }
+    logging.info(f"settings: {settings}")
+
+    # banked days of popular buckets, only used when making plans on the consumer thread
+    day_bank = make_day_bank(settings)
+
+    # menu snapshots packets refer to, missing ones are fetched through the gateway
+    if path_flag_docker:
+        gateway_host_name = "gateway"
+    else:
+        gateway_host_name = "localhost"
+    catalog_url = f"http://{gateway_host_name}:{os.getenv('GW_PORT')}/item_db/api/item/codecal"
+    snapshot_store = SnapshotStore(int(os.getenv('SNAPSHOT_STORE_MAX', 4)), catalog_url)
+    snapshot_exchange_name = os.getenv('MENU_SNAPSHOT_EXCHANGE')
+    logging.info(f"catalog_url: {catalog_url} snapshot_exchange_name: {snapshot_exchange_name}")
+
+    # plan worker processes, every core up to 4 unless set. every worker keeps
+    # its own day bank, so more workers need more memory
+    workers = os.getenv('SORTER_WORKERS', '')
+    worker_count = int(workers) if workers else min(os.cpu_count() or 1, 4)
+    logging.info(f"worker_count: {worker_count}")
+
     # signal handlers
     signal.signal(signal.SIGINT, graceful_shutdown)
     signal.signal(signal.SIGTERM, graceful_shutdown)
 
     if not test_flag:
         logging.info("Starting RabbitMQ consumer.")
-        run_consumer(queue_name, api_url, rabbitmq_user, rabbitmq_password, rabbitmq_host)
+        run_consumer(queue_name, api_url, meal_cache, day_bank, snapshot_store, snapshot_exchange_name, settings, worker_count, rabbitmq_user, rabbitmq_password, rabbitmq_host)
         logging.info("Consumer stopped.")
     # run
 